@@ -5,6 +5,8 @@ from PIL import Image, ImageFile, BmpImagePlugin, ImagePalette, _binary, ImageDr
 from PIL._binary import i8, i16le as i16, i32le as i32, \
                      o8, o16le as o16, o32le as o32
 import math
+import mmap
+import numpy as np
 
 Image.MAX_IMAGE_PIXELS = 100000000000#to avoid warning
 
@@ -145,3 +147,104 @@ def new_bitmap(self, header=0, offset=0):
 
 BmpImagePlugin.BmpImageFile._bitmap = new_bitmap 
 
+
+
+# converts a raw bmp palette (BGR or BGRX entries) into the flat RGB list used by putpalette
+def _palette_rgb(palette):
+    step = 4 if palette.rawmode == "BGRX" else 3
+    data = bytearray(palette.palette)
+    rgb = []
+    for i in range(0, len(data) - step + 1, step):
+        rgb.extend((data[i + 2], data[i + 1], data[i]))
+    return rgb
+
+
+class LabelMap(object):
+    # memory-maps the pixel data of an uncompressed 8 bit bmp label file. crops and pixel
+    # lookups only touch the rows they need, so the label image is never decoded into RAM.
+    # other layouts (1 and 4 bit bitmaps) are decoded into memory instead
+
+    # number of rows counted at a time when a full pass over the label image is needed
+    BAND_ROWS = 64
+
+    def __init__(self, path):
+        image = Image.open(path)
+        decoder, extents, offset, args = image.tile[0]
+        self.path = path
+        self.mode = image.mode if image.mode == "P" else "L"
+        self.size = image.size
+        self.palette = _palette_rgb(image.palette) if self.mode == "P" else None
+        self._histogram = None
+        if decoder != 'raw' or args[0] not in ("P", "L"):
+            self._fp = self._map = None
+            self.array = np.array(image if image.mode in ("P", "L") else image.convert("L"), dtype=np.uint8)
+            return
+        raw_mode, stride, direction = args
+        width, height = self.size
+        self._fp = open(path, 'rb')
+        self._map = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        rows = np.ndarray((height, stride), dtype=np.uint8, buffer=self._map, offset=offset)
+        # bottom-up bitmaps store the last row first
+        if direction == -1:
+            rows = rows[::-1]
+        self.array = rows[:, :width]
+
+    # wraps an array of label values in a PIL image with the label palette
+    def _image(self, arr):
+        im = Image.fromarray(arr)
+        if self.palette is not None:
+            im.putpalette(self.palette)
+        return im
+
+    # zero-copy view of the pixels inside box, clipped to the image
+    def window(self, box):
+        left, upper, right, lower = [int(v) for v in box]
+        width, height = self.size
+        return self.array[max(upper, 0):min(lower, height), max(left, 0):min(right, width)]
+
+    # same as PIL's crop: returns a small image of the box, padded with 0 outside the label image
+    def crop(self, box):
+        left, upper, right, lower = [int(v) for v in box]
+        tile = np.zeros((lower - upper, right - left), dtype=np.uint8)
+        width, height = self.size
+        l, u, r, b = max(left, 0), max(upper, 0), min(right, width), min(lower, height)
+        if l < r and u < b:
+            tile[u - upper:b - upper, l - left:r - left] = self.array[u:b, l:r]
+        return self._image(tile)
+
+    def getpixel(self, xy):
+        return int(self.array[int(xy[1]), int(xy[0])])
+
+    # pixel count of every label value, computed once in bands of rows
+    def histogram(self):
+        if self._histogram is None:
+            counts = np.zeros(256, dtype=np.int64)
+            for top in range(0, self.size[1], self.BAND_ROWS):
+                counts += np.bincount(self.array[top:top + self.BAND_ROWS].ravel(), minlength=256)
+            self._histogram = counts
+        return self._histogram
+
+    def getcolors(self, maxcolors=256):
+        colors = [(int(count), value) for value, count in enumerate(self.histogram()) if count]
+        if len(colors) > maxcolors:
+            return None
+        return colors
+
+    # returns a new thumbnail image that fits in size, sampled like PIL's thumbnail does for label images
+    def make_thumbnail(self, size):
+        x, y = self.size
+        if x > size[0]:
+            y = int(max(y * size[0] // x, 1))
+            x = int(size[0])
+        if y > size[1]:
+            x = int(max(x * size[1] // y, 1))
+            y = int(size[1])
+        rows = ((np.arange(y) + 0.5) * self.size[1] / float(y)).astype(np.intp)
+        cols = ((np.arange(x) + 0.5) * self.size[0] / float(x)).astype(np.intp)
+        return self._image(self.array[np.ix_(rows, cols)])
+
+    def close(self):
+        self.array = None
+        if self._map is not None:
+            self._map.close()
+            self._fp.close()
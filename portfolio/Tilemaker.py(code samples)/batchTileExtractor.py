@@ -0,0 +1,254 @@
+#!/usr/bin/python
+
+import os
+import sys
+import csv
+import ast
+import time
+import argparse
+import hashlib
+import traceback
+import multiprocessing
+from tileExtractor import TileExtractor, TileExtractorError, make_parser
+from tile_maker_methods import load_coordinates
+
+
+#file extensions of slide images that openslide can open
+SLIDE_EXTENSIONS = ('.svs', '.tif', '.tiff', '.ndpi', '.vms', '.vmu', '.scn', '.mrxs', '.svslide', '.bif')
+
+#seconds between looks at the running slide processes
+POLL_INTERVAL = 0.1
+
+
+
+
+#name tileExtractor.py gives to a slide (e.g. 234 for svs_path/234.svs), used for the per slide output folders
+def slide_name(svs_path):
+	s_path = svs_path.replace('/', '.').replace("\\", '.').split('.')
+	return s_path[len(s_path)-2]
+
+
+
+
+#finds the slides of a directory. a label file is used if there is one at <slide>_data/labels.bmp
+def slides_in_directory(path):
+	slides = []
+	for name in sorted(os.listdir(path)):
+		if name.lower().endswith(SLIDE_EXTENSIONS):
+			svs_path = os.path.join(path, name)
+			bmp_path = os.path.join(path, name + '_data', 'labels.bmp')
+			slides.append((svs_path, bmp_path if os.path.exists(bmp_path) else None))
+	return slides
+
+
+
+
+#reads a manifest with one slide per line: slide path and optionally a bmp label path, separated by a comma.
+#empty lines and lines starting with # are skipped, relative paths are relative to the manifest
+def slides_in_manifest(path):
+	base = os.path.dirname(os.path.abspath(path))
+	slides = []
+	with open(path) as f:
+		for row in csv.reader(f):
+			if not row or not row[0].strip() or row[0].strip().startswith('#'):
+				continue
+			svs_path = os.path.join(base, row[0].strip())
+			bmp_path = os.path.join(base, row[1].strip()) if len(row) > 1 and row[1].strip() else None
+			slides.append((svs_path, bmp_path))
+	return slides
+
+
+
+
+#names of the output folders of slides: the slide name, and for slides that share their name with another slide (e.g. 234.svs in two
+#folders of a manifest) the name and a short hash of the slide path, so that no two slides write to one folder
+def output_names(svs_paths):
+	names = [slide_name(svs_path) for svs_path in svs_paths]
+	counts = dict((name, names.count(name)) for name in names)
+	return [name if counts[name] == 1 else '{0}_{1}'.format(name, hashlib.md5(os.path.abspath(svs_path)).hexdigest()[:8]) for name, svs_path in zip(names, svs_paths)]
+
+
+
+
+#size of a slide on disk, used to schedule the largest slides first
+def slide_size(svs_path):
+	try:
+		return os.path.getsize(svs_path)
+	except OSError:
+		return 0
+
+
+
+
+#runs a TileExtractor on one slide. a failing slide only fails its own job
+def run_slide(job):
+	svs_path, bmp_path, output_dir, tile_width, tile_height, options = job
+	argv = [svs_path, str(tile_width), str(tile_height), '-out', output_dir] + options
+	if bmp_path:
+		argv = argv + ['-b', bmp_path]
+	result = {'svs_path': svs_path, 'bmp_path': bmp_path or '', 'output_dir': output_dir, 'status': 'ok', 'error': ''}
+	starttime = time.time()
+	try:
+		TileExtractor.from_args(make_parser().parse_args(argv)).run()
+	except TileExtractorError, e:
+		result['status'] = 'failed'
+		result['error'] = str(e)
+	except SystemExit, e:
+		if e.code:
+			result['status'] = 'failed'
+			result['error'] = 'exit code {0}'.format(e.code)
+	except Exception, e:
+		result['status'] = 'failed'
+		result['error'] = traceback.format_exc().strip().split('\n')[-1]
+	finally:
+		sys.stdout.flush()
+	result['seconds'] = time.time() - starttime
+	return result
+
+
+
+
+#target of the process of a slide: sends the result of the slide back to the batch process
+def run_slide_process(job, connection):
+	connection.send(run_slide(job))
+	connection.close()
+
+
+
+
+#runs every job in a process of its own, at most workers at a time, and yields their results as they finish. a slide process that
+#dies without a result (e.g. killed for memory or crashed in openslide) or that runs longer than timeout seconds is a failed slide
+def run_slides(jobs, workers, timeout = None):
+	jobs = list(jobs)
+	running = []
+	while jobs or running:
+		while jobs and len(running) < workers:
+			job = jobs.pop(0)
+			receiver, sender = multiprocessing.Pipe(False)
+			process = multiprocessing.Process(target = run_slide_process, args = (job, sender))
+			process.start()
+			#only the slide process holds the sending end, so the pipe ends when it does
+			sender.close()
+			running.append((process, receiver, job, time.time()))
+		finished = False
+		for entry in list(running):
+			process, receiver, job, starttime = entry
+			seconds = time.time() - starttime
+			result = None
+			if receiver.poll():
+				try:
+					result = receiver.recv()
+				except EOFError:
+					process.join()
+					result = {'error': 'slide process ended with exit code {0}'.format(process.exitcode)}
+			elif timeout and seconds > timeout:
+				process.terminate()
+				result = {'error': 'slide process stopped after {0} seconds'.format(timeout)}
+			if result is None:
+				continue
+			if 'status' not in result:
+				svs_path, bmp_path, output_dir = job[:3]
+				result.update(svs_path = svs_path, bmp_path = bmp_path or '', output_dir = output_dir, status = 'failed', seconds = seconds)
+			process.join()
+			receiver.close()
+			running.remove(entry)
+			finished = True
+			yield result
+		if not finished:
+			time.sleep(POLL_INTERVAL)
+
+
+
+
+#writes the coordinates of every slide that finished into one index with a row per tile: slide path, x, y, label. the coordinates
+#are read from the csv files of the slides or, with table, from their binary coordinate tables (-cf table)
+def merge_coordinates(results, path, table = False):
+	n = 0
+	with open(path, 'w') as f:
+		writer = csv.writer(f)
+		writer.writerow(('svs_path', 'x', 'y', 'label'))
+		for result in results:
+			if result['status'] != 'ok' or not os.path.isdir(result['output_dir']):
+				continue
+			if table:
+				table_path = os.path.join(result['output_dir'], 'coordinates.bin')
+				if os.path.exists(table_path):
+					for record in load_coordinates(table_path):
+						writer.writerow((result['svs_path'], record['x'], record['y'], record['label']))
+						n = n + 1
+				continue
+			for name in sorted(os.listdir(result['output_dir'])):
+				if not name.endswith('.csv'):
+					continue
+				with open(os.path.join(result['output_dir'], name)) as c:
+					for row in csv.reader(c):
+						x, y = ast.literal_eval(row[1])
+						writer.writerow((result['svs_path'], x, y, row[2]))
+						n = n + 1
+	return n
+
+
+
+
+def main():
+	parser = argparse.ArgumentParser( description =
+		"""
+		Run tileExtractor.py over a cohort of slides with a process per slide, largest slides first.
+		Slides come from a directory (with label files at <slide>_data/labels.bmp if they exist) or from a manifest with one 'slide path, bmp path' per line.
+		Any other option is passed on to tileExtractor.py, for example:
+		python batchTileExtractor.py input/ 256 256 -sw 16 -out output -r -th 0.6
+		""")
+	parser.add_argument('slides', help = 'directory of slides or manifest file')
+	parser.add_argument('tile_width', help = 'width of tiles in pixels', type = int)
+	parser.add_argument('tile_height', help = 'height of tiles in pixels', type = int)
+	parser.add_argument('-out', '--output_dir', default = 'output', help = 'path to a directory in which a folder is made for the output of each slide')
+	parser.add_argument('-sw', '--slide_workers', type = int, default = multiprocessing.cpu_count(), help = 'number of slides processed at the same time. Defaults to the number of cpus')
+	parser.add_argument('-st', '--slide_timeout', type = float, help = 'seconds after which a slide that is still running is stopped and reported as failed. By default slides are not stopped')
+	args, options = parser.parse_known_args()
+	#the options of the slides, checked once here
+	extraction = make_parser().parse_args([args.slides, str(args.tile_width), str(args.tile_height)] + options)
+
+	#the export workers of tileExtractor.py (-w) of several slides at a time would compete with the slide processes for the cpus
+	if args.slide_workers > 1 and ('-w' in options or '--workers' in options or any(option.startswith('--workers=') for option in options)):
+		parser.error('-w (export workers per slide) only works with one slide at a time (-sw 1)')
+
+	if os.path.isdir(args.slides):
+		slides = slides_in_directory(args.slides)
+	else:
+		slides = slides_in_manifest(args.slides)
+	slides.sort(key = lambda slide: slide_size(slide[0]), reverse = True)
+
+	if not os.path.exists(args.output_dir):
+		os.makedirs(args.output_dir)
+
+	names = output_names([svs_path for svs_path, bmp_path in slides])
+	jobs = [(svs_path, bmp_path, os.path.join(args.output_dir, name), args.tile_width, args.tile_height, options) for (svs_path, bmp_path), name in zip(slides, names)]
+	print '---', len(jobs), 'slides,', args.slide_workers, 'workers ---'
+
+	#every slide runs in a new process, so a crash only fails its slide and nothing of a slide stays in memory after it
+	starttime = time.time()
+	results = []
+	for result in run_slides(jobs, max(args.slide_workers, 1), args.slide_timeout):
+		results.append(result)
+		print '--- {0}/{1} {2} {3} in {4:.1f} seconds {5}'.format(len(results), len(jobs), result['svs_path'], result['status'], result['seconds'], result['error'])
+		sys.stdout.flush()
+
+	#per slide timings and failures
+	with open(os.path.join(args.output_dir, 'batch_report.csv'), 'w') as f:
+		writer = csv.writer(f)
+		writer.writerow(('svs_path', 'bmp_path', 'status', 'seconds', 'error'))
+		for result in results:
+			writer.writerow((result['svs_path'], result['bmp_path'], result['status'], '{0:.2f}'.format(result['seconds']), result['error']))
+
+	if not extraction.save_tile_images:
+		n = merge_coordinates(results, os.path.join(args.output_dir, 'coordinates.csv'), table = extraction.coordinate_format == 'table')
+		print '---', n, 'tile coordinates written to', os.path.join(args.output_dir, 'coordinates.csv'), '---'
+
+	failed = len([r for r in results if r['status'] != 'ok'])
+	print '--- {0} slides done in {1:.1f} seconds, {2} failed ---'.format(len(results), time.time() - starttime, failed)
+	if failed:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
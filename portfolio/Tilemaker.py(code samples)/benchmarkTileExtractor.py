@@ -0,0 +1,289 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import platform
+import tempfile
+import argparse
+import subprocess
+import contextlib
+import numpy as np
+import openslide
+import PatchedPIL
+from tile_maker_methods import segment_tissue, LabelIntegral, integral_cell, tile_values, score_in_batches, random_coordinates, TileTracker, read_tile, encode_tile, CoordinateWriter, TileShardWriter
+from tileExtractor import TileExtractor
+
+
+#colors of the labels in the synthetic label images. label 0 (unlabeled) is white like in our label files
+LABEL_COLORS = [(255,255,255), (230,40,40), (40,160,40), (40,40,230), (230,200,30), (170,40,200), (30,200,200), (250,130,30), (120,120,120)]
+
+#rows of the synthetic slide and label image made at a time
+BAND_ROWS = 512
+
+#resolution written into the synthetic slides
+MPP = 0.25
+
+
+
+
+#tissue of the synthetic slides is an ellipse in the middle of the slide covering about half of it
+def tissue_mask(width, height, y0, y1):
+	y, x = np.ogrid[y0:y1, 0:width]
+	return ((x - width/2.0)/(width*0.4))**2 + ((y - height/2.0)/(height*0.4))**2 <= 1
+
+
+
+
+#labels of rows y0 to y1 of a synthetic label image. 'blobs' are random ellipses of every label in the tissue, 'bands' are vertical stripes
+#of all labels across the tissue (which makes a lot of label borders)
+def label_rows(width, height, y0, y1, labels, layout, seed=1):
+	rows = np.zeros((y1 - y0, width), np.uint8)
+	tissue = tissue_mask(width, height, y0, y1)
+	if layout == 'bands':
+		stripe = max(width/(4*labels), 1)
+		rows[:] = (np.arange(width)/stripe) % labels + 1
+	else:
+		rng = random.Random(seed)
+		y, x = np.ogrid[y0:y1, 0:width]
+		for i in range(4*labels):
+			cx, cy = rng.uniform(0.25, 0.75)*width, rng.uniform(0.25, 0.75)*height
+			rx, ry = rng.uniform(0.04, 0.12)*width, rng.uniform(0.04, 0.12)*height
+			if cy + ry < y0 or cy - ry > y1:
+				continue
+			rows[((x - cx)/rx)**2 + ((y - cy)/ry)**2 <= 1] = i % labels + 1
+	rows[~tissue] = 0
+	return rows
+
+
+
+
+#writes a synthetic label image as an uncompressed 8 bit bmp (what PatchedPIL.LabelMap maps), one band of rows at a time
+def write_label_bmp(path, width, height, labels, layout):
+	stride = (width + 3) & ~3
+	palette = ''.join(struct.pack('<BBBB', b, g, r, 0) for r, g, b in (LABEL_COLORS + [(0,0,0)]*256)[:256])
+	offset = 14 + 40 + len(palette)
+	with open(path, 'wb') as f:
+		f.write(struct.pack('<2sIHHI', 'BM', offset + stride*height, 0, 0, offset))
+		f.write(struct.pack('<IiiHHIIiiII', 40, width, height, 1, 8, 0, stride*height, 2835, 2835, 256, 0))
+		f.write(palette)
+		#bmp rows go from the bottom up
+		for y1 in range(height, 0, -BAND_ROWS):
+			y0 = max(y1 - BAND_ROWS, 0)
+			rows = np.zeros((y1 - y0, stride), np.uint8)
+			rows[:, :width] = label_rows(width, height, y0, y1, labels, layout)
+			f.write(rows[::-1].tobytes())
+
+
+
+
+#writes a synthetic tiled, pyramidal tiff with an aperio description (so openslide reads its mpp) and the tissue and labels of
+#label_rows. level 0 is made in a memory-mapped scratch file next to the slide, the other levels are taken from it every 4th pixel
+def write_slide(path, width, height, labels, layout, tile=256):
+	import tifffile
+	scratch = path + '.scratch'
+	level0 = np.memmap(scratch, np.uint8, 'w+', shape = (height, width, 3))
+	for y0 in range(0, height, BAND_ROWS):
+		y1 = min(y0 + BAND_ROWS, height)
+		rng = np.random.RandomState(y0)
+		band = np.empty((y1 - y0, width, 3), np.uint8)
+		band[:] = (243, 243, 243)
+		tissue = tissue_mask(width, height, y0, y1)
+		band[tissue] = (215, 140, 175)
+		band[label_rows(width, height, y0, y1, labels, layout) > 0] = (170, 90, 150)
+		noise = rng.randint(-12, 13, size = band.shape[:2])
+		level0[y0:y1] = np.clip(band + noise[:, :, np.newaxis], 0, 255)
+	level0.flush()
+
+	description = 'Aperio Image Library v11.2.1\n{0}x{1} [0,0 {0}x{1}] ({2}x{2}) RAW|AppMag = 40|MPP = {3}'.format(width, height, tile, MPP)
+	with tifffile.TiffWriter(path, bigtiff = True) as tif:
+		downsample = 1
+		while downsample == 1 or (width/downsample >= tile and height/downsample >= tile):
+			level = np.ascontiguousarray(level0[::downsample, ::downsample])
+			tif.save(level, tile = (tile, tile), photometric = 'rgb', description = description if downsample == 1 else None, metadata = None)
+			downsample = downsample*4
+	del level0
+	os.remove(scratch)
+
+
+
+
+#makes (or reuses) the synthetic slide and label image for the benchmark parameters
+def synthetic_slide(data_dir, width, height, labels, layout):
+	if not os.path.exists(data_dir):
+		os.makedirs(data_dir)
+	name = os.path.join(data_dir, 'synthetic_{0}x{1}_{2}_{3}'.format(width, height, labels, layout))
+	if not os.path.exists(name + '.svs'):
+		write_slide(name + '.svs.tmp', width, height, labels, layout)
+		os.rename(name + '.svs.tmp', name + '.svs')
+	if not os.path.exists(name + '.bmp'):
+		write_label_bmp(name + '.bmp.tmp', width, height, labels, layout)
+		os.rename(name + '.bmp.tmp', name + '.bmp')
+	return name + '.svs', name + '.bmp'
+
+
+
+
+#times the stage in the with block and adds it to the report. the block can set 'count' (number of items processed) in the dict it gets
+@contextlib.contextmanager
+def stage(report, name):
+	result = {}
+	starttime = time.time()
+	yield result
+	result['seconds'] = time.time() - starttime
+	if result.get('count'):
+		result['per_second'] = result['count']/result['seconds'] if result['seconds'] else None
+	report['stages'][name] = result
+	print '{0:<20} {1:8.3f} s {2}'.format(name, result['seconds'], '({0} items)'.format(result['count']) if result.get('count') else '')
+	sys.stdout.flush()
+
+
+
+
+def git_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__))).strip()
+	except Exception, e:
+		return None
+
+
+
+
+#times the stages of an extraction on the synthetic slide one by one, then a whole extraction with TileExtractor
+def benchmark(args, svs_path, bmp_path):
+	report = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(), 'platform': platform.platform(),
+		'openslide': getattr(openslide, '__library_version__', None), 'parameters': vars(args), 'stages': {}}
+	tile = args.tile_size
+	output_dir = tempfile.mkdtemp(prefix = 'tile_benchmark')
+
+	try:
+		with stage(report, 'open_slide'):
+			svs = openslide.OpenSlide(svs_path)
+		lx, ly = svs.dimensions
+
+		with stage(report, 'thumbnail'):
+			svs_thumbnail = svs.get_thumbnail((args.thumbnail_size, args.thumbnail_size))
+
+		with stage(report, 'segmentation'):
+			tissue, boxes = segment_tissue(np.asarray(svs_thumbnail.convert('RGB')))
+
+		with stage(report, 'open_label_image'):
+			label_img = PatchedPIL.LabelMap(bmp_path)
+			label_img.make_thumbnail((args.thumbnail_size, args.thumbnail_size))
+
+		with stage(report, 'label_index'):
+			label_index = LabelIntegral(label_img, integral_cell(tile, tile))
+
+		#scoring of random candidates against the label image, as tileExtractor.py -r -b does
+		b_ratio = float(svs_thumbnail.size[0])/float(lx)
+		score = lambda coords: tile_values(label_index, coords, b_ratio, False, None, tile, tile, 0.5, 0.0)
+		with stage(report, 'scoring') as result:
+			scored = list(score_in_batches(random_coordinates(lx - tile, ly - tile, args.candidates, random.Random(1)), score))
+			result['count'] = len(scored)
+		labeled = [(x, y, label) for x, y, label in scored if label != 0]
+
+		with stage(report, 'overlap_tracking') as result:
+			tracker = TileTracker(tile, tile)
+			accepted = []
+			for x, y, label in labeled:
+				if tracker.accepts(x, y, tile, tile, args.overlap):
+					tracker.add(x, y, tile, tile)
+					accepted.append((x, y, label))
+			result['count'] = len(labeled)
+		report['accepted_tiles'] = len(accepted)
+
+		with stage(report, 'read_region') as result:
+			tiles = [read_tile(svs, x, y, tile, tile) for x, y, label in accepted[:args.read_tiles]]
+			result['count'] = len(tiles)
+
+		with stage(report, 'encode_png') as result:
+			encoded = [encode_tile(t) for t in tiles]
+			result['count'] = len(encoded)
+
+		with stage(report, 'encode_jpeg') as result:
+			result['count'] = len([encode_tile(t, True) for t in tiles])
+
+		with stage(report, 'write_coordinates') as result:
+			writer = CoordinateWriter(output_dir, range(1, args.labels + 1), 'synthetic', True, True)
+			for x, y, label in accepted:
+				writer.write(x, y, label)
+			writer.close()
+			result['count'] = len(accepted)
+
+		with stage(report, 'write_shards') as result:
+			shards = TileShardWriter(output_dir, 'synthetic')
+			for (x, y, label), data in zip(accepted, encoded):
+				shards.add(x, y, label, data)
+			shards.close()
+			result['count'] = len(encoded)
+		svs.close()
+		label_img.close()
+
+		#the whole pipeline as the command line runs it
+		with stage(report, 'extraction') as result:
+			extractor = TileExtractor(svs_path, tile, tile, bmp_path = bmp_path, random_selection = True, overlap = args.overlap, output_dir = os.path.join(output_dir, 'extraction'), thumbnail = True, checkpoint_interval = 0)
+			extractor.run()
+			result['count'] = extractor.tiles_checked
+		report['extracted_tiles'] = extractor.tiles_found
+	finally:
+		shutil.rmtree(output_dir, True)
+	return report
+
+
+
+
+#prints the change of every stage against an earlier report
+def compare(report, old):
+	print '\n{0:<20} {1:>10} {2:>10} {3:>8}'.format('stage', 'before', 'now', 'change')
+	for name, result in sorted(report['stages'].items()):
+		if name in old.get('stages', {}):
+			before = old['stages'][name]['seconds']
+			change = '{0:+.0f}%'.format((result['seconds'] - before)*100/before) if before else ''
+			print '{0:<20} {1:10.3f} {2:10.3f} {3:>8}'.format(name, before, result['seconds'], change)
+
+
+
+
+def main():
+	parser = argparse.ArgumentParser( description =
+		"""
+		Benchmark of the tile extraction pipeline on a synthetic slide. A tiled, pyramidal tiff slide (readable by openslide) and a matching bmp label file
+		are generated in the data directory (and reused by later runs with the same size and labels), then every stage is timed and the times are written
+		to a json report. Needs tifffile to generate slides. For example, to compare two commits:
+		python benchmarkTileExtractor.py -s 40000 30000 -o before.json, then after the change: python benchmarkTileExtractor.py -s 40000 30000 -o after.json -c before.json
+		""")
+	parser.add_argument('-s', '--size', type = int, nargs = 2, default = (20000, 15000), metavar = ('WIDTH', 'HEIGHT'), help = 'width and height of the synthetic slide in pixels. Defaults to 20000 15000')
+	parser.add_argument('-l', '--labels', type = int, default = 3, help = 'number of labels in the synthetic label image. Defaults to 3')
+	parser.add_argument('-ll', '--label_layout', choices = ('blobs', 'bands'), default = 'blobs', help = "'blobs' (default) for random ellipses of labels in the tissue, 'bands' for stripes of all labels across the tissue")
+	parser.add_argument('-t', '--tile_size', type = int, default = 256, help = 'width and height of the tiles in pixels. Defaults to 256')
+	parser.add_argument('-ts', '--thumbnail_size', type = int, default = 2000, help = 'size of the thumbnails. Defaults to 2000')
+	parser.add_argument('-n', '--candidates', type = int, default = 100000, help = 'number of random tile candidates that are scored. Defaults to 100000')
+	parser.add_argument('-ov', '--overlap', type = float, default = 0.0, help = 'maximum tile overlap in overlap tracking and extraction. Defaults to 0')
+	parser.add_argument('-rt', '--read_tiles', type = int, default = 500, help = 'number of accepted tiles that are read and encoded. Defaults to 500')
+	parser.add_argument('-d', '--data_dir', default = 'benchmark_data', help = 'directory for the synthetic slides. Defaults to benchmark_data')
+	parser.add_argument('-o', '--report', default = 'benchmark_report.json', help = 'path of the json report. Defaults to benchmark_report.json')
+	parser.add_argument('-c', '--compare', help = 'an earlier report to compare the stage times with')
+	args = parser.parse_args()
+
+	width, height = args.size
+	print '--- synthetic slide {0}x{1} with {2} labels ({3}) ---'.format(width, height, args.labels, args.label_layout)
+	starttime = time.time()
+	svs_path, bmp_path = synthetic_slide(args.data_dir, width, height, args.labels, args.label_layout)
+	print '--- ready in {0:.1f} seconds ---'.format(time.time() - starttime)
+
+	report = benchmark(args, svs_path, bmp_path)
+	with open(args.report, 'w') as f:
+		json.dump(report, f, indent = 2, sort_keys = True)
+	print '--- report written to', args.report, '---'
+
+	if args.compare:
+		with open(args.compare) as f:
+			compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+	main()
@@ -10,608 +10,974 @@ import random
 import time
 import argparse
 import csv
+import array
+import json
+import cPickle
+from itertools import islice
 import tile_maker_methods 
-from tile_maker_methods import rec, tile_by_label_threshold_nb, tile_by_threshold_on_thumbnail, get_center_pixel, tile_value, check_tiles
+from tile_maker_methods import check_tiles, LabelIntegral, integral_cell, CoordinateWriter, COORDINATE_DTYPE, SlideCache, HandleCache, ThumbnailRenderer, Metrics, pyramid_level, TileShardWriter, TileArrayWriter, TileBlocks, read_block, encode_tile, tile_values, score_in_batches, SCORE_BATCH, SAMPLE_BATCH, random_coordinates, TileTracker, EligibleSampler, segment_tissue, read_tile, read_tiles, export_tile, TileExportPool
 
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.image as mpimg
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-
-import skimage
-from skimage.filters import threshold_otsu
-from skimage.segmentation import clear_border
-from skimage.measure import label, regionprops
-from skimage.morphology import closing, square
-from skimage.color import label2rgb, rgb2gray
-from skimage.util import invert
-
-import cv2
-import warnings
-
-
-parser = argparse.ArgumentParser( description = 
-	"""
-	Generate tiles from slide images or from slide images with bmp label file.
-	Options are: tiles from tissue, tiles from labeled areas only, tiles from both labeled areas and unlabeled areas, tiles only from tissue border or tiles only from label borders.
-	for example, to generate all possible labeled tiles of width 256 pixels and height 256 pixels write: 	
-	python tileExtractor.py svs_path/234.svs output_path/folder 256 256 -b bmp_path/123.bmp
-	""")
-parser.add_argument('svs_path', help = 'path to svs slide')
-parser.add_argument('tile_width', help = 'width of tiles in pixels', type = int)
-parser.add_argument('tile_height', help = 'height of tiles in pixels', type = int)
-parser.add_argument('-out', '--output_dir', default = 'output', help = 'path to a directory in which the generated tiles will be saved')
-parser.add_argument('-b', '--bmp_path', type = str, help = 'path to bmp label file')
-parser.add_argument('-mpp', '--mpp', type = float, help = 'specifies the resolution of the generates tiles. default is the slide\'s original resolution. for standardized 20X tiles use -mpp 0.45 and for standardized 10X tiles use -mpp 0.9 etc...')
-parser.add_argument('-th', '--threshold', type = float, default = 0.5, help = "fraction of labeled pixels per resulting tile. Defaults to 0.5. For a different percentage enter a float value between 0 and 1: e.g. '-th 0.6' generates tiles that have at least 60 percent of pixels labeled.")
-parser.add_argument('-cp', '--center_pixel', type = int, help = "selects tiles by the value of their center pixel: '-cp 1' to generate tiles with labeled center pixel (without checking the tile --threshold). '-cp 2' for tiles with labeled center pixel and label threshold as specified by -th option. If -cp is omitted (default), the center pixel is ignored.")
-parser.add_argument('-r', '--random_selection', action = "store_true", help = "selects tiles from random locations with uniform distribution. The default number of tile candidates is (width/tile_width * height/tile_height * 10), and by default tiles are selected with no overlap. To specify the number of tile candidates and overlap use -m and -o parameters.")
-parser.add_argument('-m', '--max_tile_candidates', type = int, default = 0, help = "specifies the number of tile candidates in random selection. E.g. -m 300 will generate 300 random tiles and save all the tiles that fit the selection criteria. Defaults to (width/tile_width * height/tile_height * 10)")
-parser.add_argument('-ms', '--max_tiles_selected', type = int, help = "maximum number of tiles that will be generated per slide (only works on random tile selection) E.g. -ms 100 will generate up to 100 tiles, default is no maximum")
-parser.add_argument('-o', '--overlap', type = float, default = 0, help = "For row-by-row selection (default): number of pixels by which tiles should overlap side to side. E.g. '-o 50' will generate tiles with overlap by 50 pixels on each side. For random selection: A number between 0.0 and 1.0 where '-o 0.0' means that 0 percent of pixel overlap is allowed between accepted tiles, and '-o 1.0' means that entire tile overlap is allowed. Defaults to no overlap ('-o 0').")
-parser.add_argument('-bti', '--background_tiles', action = 'store_true', help = 'saves tiles from unlabeled tissue region to a folder in the output folder. Background detection is done with otsu_thresholding and pixel color thresholding. By default this option is off')
-parser.add_argument('-bth', '--background_threshold', type = float, default = 0.0, help = 'float between 0.0 and 1.0 specifying the minimum percentage of background in each tile. note: with no label file this will give tiles on the edge of borders, and with a label file it will give tiles on the edge of labels')
-parser.add_argument('-sb', '--show_bmp_tiles', action = "store_true", help = "for testing: saves tiles from the bmp file as well as from the svs file to the output folder")
-parser.add_argument('-j', '--jpeg_tiles', action = "store_true", help = "by default tiles will be saved as png images, to save the tiles in jpeg format select this option")
-parser.add_argument('-si', '--save_tile_images', action = "store_true", help = "in order to save images of the tiles instead of getting tile coordinates in a csv file use this command. each category of tile will be saved to a seperate folder in the output directory")
-parser.add_argument('-t', '--thumbnail', action = "store_true", help = "shows thumbnails with tile locations in output folder: this will show one thumbnail of the slide image, one of the label image and one with the labels overlayed on the slide")
-parser.add_argument('-sr', '--show_rejected_tiles', action = "store_true", help = "displays locations of rejected tiles in thumbnails")
-parser.add_argument('-v', '--verbose', action = "store_true", help = "show progress and output information")
-args = parser.parse_args()
-
-if args.verbose:
-	print "\n---    Tile Extractor. For help: python bmpTileExtractor.py -h    ---\n"
-
-
-if (args.background_threshold + args.threshold > 1.0):
-	print 'there are no tiles with', args.background_threshold*100, 'percent background and,', args.threshold*100, 'percent tissue. please fix your thresholds'
-	sys.exit(1)
-
-
-overlap = args.overlap
-
-#find/make output directory
-output_dir = args.output_dir
-if not os.path.exists(output_dir):
-	os.makedirs(output_dir)
-starttime = time.time()
-
-#get tile size
-tile_x = args.tile_width
-tile_y = args.tile_height
-
-
-#open slide image
-try:
-	svs = openslide.OpenSlide(args.svs_path)
-	lx, ly = svs.dimensions
-except Exception, e:
-	print >> sys.stderr, "Exception can not open", args.svs_path, "%s. note: this may be an issue with openslide in your environment and switching to a different python environment might help" % str(e)
-	sys.exit(1)
-
-
-#get slide resolution
-mpp_x = float(svs.properties[openslide.PROPERTY_NAME_MPP_X])
-mpp_y = float(svs.properties[openslide.PROPERTY_NAME_MPP_Y])
-resolution = (mpp_x + mpp_y)/2
-
-
-#get tile size and overlap for specifies resolution
-if args.mpp:
-	tile_x = int(tile_x*args.mpp/mpp_x)
-	tile_y = int(tile_y*args.mpp/mpp_y)
-	if not args.random_selection:
-		overlap = args.overlap*args.mpp/resolution
-
-
-#open BMP label file
-if args.bmp_path:
-	try:
-		label_img = Image.open(args.bmp_path)
-	except Exception, e:
-		print >> sys.stderr, "Exception can not open", args.bmp_path, "%s" % str(e)
-		sys.exit(1)
-
-	#get dimensions of image
-	if (svs.dimensions != (label_img.size[0], label_img.size[1]) ):
-		print 'Slide', svs.dimensions, 'and BMP (', lx, ',', ly, ') have different dimensions'
-		sys.exit(1)
 
+#number of tile candidates checked between looking at the checkpoint and metrics feed clocks
+CHECKPOINT_STEP = 4096
+
+#seconds between checkpoints with -re when -ci is not given
+CHECKPOINT_INTERVAL = 300
+
+
+
+
+#raised when an extraction can not be set up, e.g. when the slide can not be opened or the options do not make sense
+class TileExtractorError(Exception):
+	pass
+
+
+
+
+def make_parser():
+	parser = argparse.ArgumentParser( description = 
+		"""
+		Generate tiles from slide images or from slide images with bmp label file.
+		Options are: tiles from tissue, tiles from labeled areas only, tiles from both labeled areas and unlabeled areas, tiles only from tissue border or tiles only from label borders.
+		for example, to generate all possible labeled tiles of width 256 pixels and height 256 pixels write: 	
+		python tileExtractor.py svs_path/234.svs output_path/folder 256 256 -b bmp_path/123.bmp
+		""")
+	parser.add_argument('svs_path', help = 'path to svs slide')
+	parser.add_argument('tile_width', help = 'width of tiles in pixels', type = int)
+	parser.add_argument('tile_height', help = 'height of tiles in pixels', type = int)
+	parser.add_argument('-out', '--output_dir', default = 'output', help = 'path to a directory in which the generated tiles will be saved')
+	parser.add_argument('-b', '--bmp_path', type = str, help = 'path to bmp label file')
+	parser.add_argument('-mpp', '--mpp', type = float, nargs = '+', help = 'specifies the resolution of the generates tiles. default is the slide\'s original resolution. for standardized 20X tiles use -mpp 0.45 and for standardized 10X tiles use -mpp 0.9 etc... Several resolutions can be given (e.g. -mpp 0.5 1.0 2.0): tiles are selected at the first one and every accepted tile is also saved at the others, centred on the same point and cut from one read of the slide. Tile images then go to a folder per resolution in the label folders (1/0.5/, 1/1.0/, ...) under the same name, and the rows of the csv files get the resolution and (x, y, width, height) region of every resolution')
+	parser.add_argument('-pr', '--pyramid_reads', action = "store_true", help = "with -mpp, reads tiles from the closest pyramid level of the slide instead of reading them at full resolution and shrinking them. Much faster for low magnification tiles")
+	parser.add_argument('-th', '--threshold', type = float, default = 0.5, help = "fraction of labeled pixels per resulting tile. Defaults to 0.5. For a different percentage enter a float value between 0 and 1: e.g. '-th 0.6' generates tiles that have at least 60 percent of pixels labeled.")
+	parser.add_argument('-cp', '--center_pixel', type = int, help = "selects tiles by the value of their center pixel: '-cp 1' to generate tiles with labeled center pixel (without checking the tile --threshold). '-cp 2' for tiles with labeled center pixel and label threshold as specified by -th option. If -cp is omitted (default), the center pixel is ignored.")
+	parser.add_argument('-r', '--random_selection', action = "store_true", help = "selects tiles from random locations with uniform distribution. The default number of tile candidates is (width/tile_width * height/tile_height * 10), and by default tiles are selected with no overlap. To specify the number of tile candidates and overlap use -m and -o parameters.")
+	parser.add_argument('-m', '--max_tile_candidates', type = int, default = 0, help = "specifies the number of tile candidates in random selection. E.g. -m 300 will generate 300 random tiles and save all the tiles that fit the selection criteria. Defaults to (width/tile_width * height/tile_height * 10)")
+	parser.add_argument('-es', '--eligible_sampling', action = "store_true", help = "for random selection: draws tile candidates only from the parts of the slide where a tile can pass the thresholds (found from the label or tissue index) and skips candidates that would overlap accepted tiles too much, so far fewer candidates are checked. The default number of tile candidates is then counted over those parts only")
+	parser.add_argument('-ms', '--max_tiles_selected', type = int, help = "maximum number of tiles that will be generated per slide (only works on random tile selection) E.g. -ms 100 will generate up to 100 tiles, default is no maximum")
+	parser.add_argument('-o', '--overlap', type = float, default = 0, help = "For row-by-row selection (default): number of pixels by which tiles should overlap side to side. E.g. '-o 50' will generate tiles with overlap by 50 pixels on each side. For random selection: A number between 0.0 and 1.0 where '-o 0.0' means that 0 percent of pixel overlap is allowed between accepted tiles, and '-o 1.0' means that entire tile overlap is allowed. Defaults to no overlap ('-o 0').")
+	parser.add_argument('-bti', '--background_tiles', action = 'store_true', help = 'saves tiles from unlabeled tissue region to a folder in the output folder. Background detection is done with otsu_thresholding and pixel color thresholding. By default this option is off')
+	parser.add_argument('-bth', '--background_threshold', type = float, default = 0.0, help = 'float between 0.0 and 1.0 specifying the minimum percentage of background in each tile. note: with no label file this will give tiles on the edge of borders, and with a label file it will give tiles on the edge of labels')
+	parser.add_argument('-bb', '--boundary_band', action = "store_true", help = "with -bth, only checks tile candidates near label (or tissue) boundaries: the boundaries are found once from the label index and tiles that can not touch one (and so have a single label and fail -bth) are never scored. Tiles are accepted by the same rules. In random selection the candidates are drawn from the band around the boundaries like with -es")
+	parser.add_argument('-ts', '--thumbnail_size', type = int, default = 2000, help = "maximum width and height in pixels of the slide and label thumbnails used for background detection and for the -t thumbnails. Defaults to 2000")
+	parser.add_argument('-mra', '--min_region_area', type = int, default = 600, help = "tissue regions smaller than this number of thumbnail pixels are ignored by background detection. Defaults to 600")
+	parser.add_argument('-cd', '--cache_dir', help = "directory in which the thumbnails and the tissue segmentation of slides are kept, so that later runs on the same slide (with any tile size, thresholds or overlap) skip making them. Entries are renewed when the slide or label file changes. By default nothing is cached")
+	parser.add_argument('-cs', '--cache_size', type = int, default = 2048, help = "maximum size of the -cd directory in MB, the least recently used slides are removed first. Defaults to 2048")
+	parser.add_argument('-sb', '--show_bmp_tiles', action = "store_true", help = "for testing: saves tiles from the bmp file as well as from the svs file to the output folder")
+	parser.add_argument('-j', '--jpeg_tiles', action = "store_true", help = "by default tiles will be saved as png images, to save the tiles in jpeg format select this option")
+	parser.add_argument('-si', '--save_tile_images', action = "store_true", help = "in order to save images of the tiles instead of getting tile coordinates in a csv file use this command. each category of tile will be saved to a seperate folder in the output directory")
+	parser.add_argument('-sh', '--shards', action = "store_true", help = "with -si, packs the tile images into shard files (<slide>_00000.tiles, ...) with an index of their offsets, labels and coordinates (<slide>_00000.index) instead of saving one file per tile. The tiles can be read with tile_maker_methods.TileShardReader")
+	parser.add_argument('-shs', '--shard_size', type = int, default = 1024, help = "maximum size of a shard file in MB with -sh. Defaults to 1024")
+	parser.add_argument('-na', '--ndarray', action = "store_true", help = "with -si, writes the tile images without encoding them into one memory-mapped uint8 array (<slide>_tiles.npy) of shape (tiles, tile_height, tile_width, 3) that grows as tiles are found, with the coordinates and label of every tile in the same row of <slide>_tiles_index.npy. Both can be read with numpy.load(path, mmap_mode='r'). RGBA is cut to RGB and -mpp tiles are shrunk on the way in")
+	parser.add_argument('-cf', '--coordinate_format', choices = ('csv', 'table', 'both'), default = 'csv', help = "format of the tile coordinates when tile images are not saved: 'csv' (default) writes a csv file per label, 'table' writes one binary table (coordinates.bin) of slide number, x, y, label and pyramid level records that can be loaded with tile_maker_methods.load_coordinates, 'both' writes both")
+	parser.add_argument('-w', '--workers', type = int, default = 0, help = "number of worker processes that read and save tile images in parallel with -si. E.g. '-w 8'. Defaults to 0 (tiles are saved one after another by the main process)")
+	parser.add_argument('-br', '--block_reads', type = int, default = 0, help = "with -si (or tiles()), reads neighbouring tiles of a row or column that touch or overlap (row-by-row selection with -o) with one read_region call of at most this many MB and cuts the tiles out of it, so the overlapping parts are only decoded once. Not used with -pr or several -mpp resolutions. Defaults to 0 (every tile is read on its own)")
+	parser.add_argument('-ci', '--checkpoint_interval', type = int, help = "seconds between checkpoints of the extraction state (<slide>.checkpoint in the output folder) that -re can continue from. By default no checkpoints are made, or every {0} seconds with -re".format(CHECKPOINT_INTERVAL))
+	parser.add_argument('-re', '--resume', action = "store_true", help = "continues an interrupted run from its last checkpoint, with the same output as an uninterrupted run. The other options have to be the same as in the interrupted run. Without a checkpoint the run starts from the beginning and makes checkpoints, so a run started with -re can be resumed with -re")
+	parser.add_argument('-mr', '--metrics_report', action = "store_true", help = "writes a json report (<slide>_metrics.json in the output folder) with the time and calls of every stage (open, thumbnail, segmentation, label index, candidates, scoring, overlap, read_region, encode, write), the number of rejected tiles by reason, bytes written and peak memory")
+	parser.add_argument('-mf', '--metrics_feed', type = float, default = 0, help = "writes a line of json with the tiles checked and found (and per second) to stderr every this many seconds. Defaults to 0 (no feed)")
+	parser.add_argument('-t', '--thumbnail', action = "store_true", help = "shows thumbnails with tile locations in output folder: this will show one thumbnail of the slide image, one of the label image and one with the labels overlayed on the slide")
+	parser.add_argument('-sr', '--show_rejected_tiles', action = "store_true", help = "displays locations of rejected tiles in thumbnails")
+	parser.add_argument('-v', '--verbose', action = "store_true", help = "show progress and output information")
+	return parser
+
+
+
+
+#returns the options of an extraction with the same defaults as the command line, e.g. extraction_options('234.svs', 256, 256, bmp_path = 'labels.bmp', random_selection = True).
+#the slide path and tile size are set after parsing the defaults, so that a bad value raises a TileExtractorError instead of ending the program like argparse does
+def extraction_options(svs_path, tile_width, tile_height, **options):
+	args = make_parser().parse_args(['svs_path', '0', '0'])
+	args.svs_path = svs_path
+	for name, value in (('tile_width', tile_width), ('tile_height', tile_height)):
+		try:
+			size = int(value)
+			whole = size == float(value)
+		except (TypeError, ValueError):
+			whole = False
+		if not whole:
+			raise TileExtractorError('{0} has to be a whole number of pixels, not {1!r}'.format(name, value))
+		setattr(args, name, size)
+	for name, value in options.items():
+		if not hasattr(args, name):
+			raise TypeError('unknown tile extraction option {0}'.format(name))
+		setattr(args, name, value)
+	return args
 
-#check if background detection is needed
-ineedbackground = False
-if (not args.bmp_path) or args.background_tiles or (args.background_threshold and not args.bmp_path):
-	ineedbackground = True
-
-
-
-#find maximum tiles to check in random selection and if none is specified set to default value
-if (args.max_tile_candidates == 0):
-	max_tiles = int((float(lx)/float(tile_x))*(float(ly)/float(tile_y))*10*(1+args.overlap))
-else:
-	max_tiles = args.max_tile_candidates
-
-
-
-#if row by row get the number tiles that will be checked
-if not args.random_selection:
-	max_tiles = int(float(lx)/float(tile_x-overlap)*float(ly)/float(tile_y-overlap))
-
-
-
-#print variables for user debugging purposes
-if (args.verbose):
-	print 'Slide path is', args.svs_path
-	if (args.bmp_path):
-		print 'Label image path is', args.bmp_path
-	print 'Output directory is', output_dir
-	print 'Image dimensions are:', svs.dimensions
-	if (args.bmp_path):
-		print 'Label image dimensions are: (', lx,',', ly, ')'
-	print 'The slide\'s objective power is', svs.properties[openslide.PROPERTY_NAME_OBJECTIVE_POWER]
-	print 'The slide\'s resolution is', resolution
-	print 'Tile width is:', args.tile_width, ', tile height is:', args.tile_height
-	if (args.center_pixel == 1):
-		print 'Tiles are selected by the value of their center pixel'
-	elif (args.center_pixel == 2):
-		print 'Tiles are saved if they are more than', int(args.threshold*100), 'percent labeled and if the center pixel is labeled'
-	else:
-		print 'Tiles are saved if they are more than', int(args.threshold*100), 'percent labeled'
-	if (args.random_selection):
-		print 'Tiles are checked in a uniform random distribution with an overlap of', int(args.overlap*100), 'percent and a maximum of', max_tiles,'tiles checked' 
-	else:
-		print 'Tiles are checked row-by-row with an overlap of', int(args.overlap),'pixels, and a maximum of', max_tiles, 'tiles checked'
-	if (args.jpeg_tiles):
-		print 'Tiles will be saved in jpeg format'
-	else:
-		print 'Tiles will be saved in png format'
-	if (args.background_tiles):
-		print 'Tiles from unlabeled areas of tissue will also be saved'
-	else:
-		print 'Tiles from unlabeled areas of tissue will not be saved'
-	if (args.show_bmp_tiles):
-		print 'Bmp tiles will also be saved in output folders'
-	if (args.thumbnail):
-		print 'Thumbnails showing tile locations will be saved in the output folder'
-	else:
-		print 'No thumbnails will be saved'
-	if (args.show_rejected_tiles):
-		print 'The locations of rejected tiles will be shown in the thumbnails'
-	else:
-		print 'The locations of rejected tiles will not be shown in the thumbnails'
-
-
-if (args.verbose):
-	sys.stdout.write('---   all files opened successfully   ---')
-	sys.stdout.flush()
-
-
-#bmp thumbnail
-if args.thumbnail:
-	if args.verbose:
-		sys.stdout.write('\r---        creating thumbnails        ---')
-		sys.stdout.flush()
 
 
-	
-#create thumbnail of slide image, record size and ratio to slide
-svs_thumbnail = svs.get_thumbnail((2000,2000))
-b_width, b_height = svs_thumbnail.size
-b_ratio = float(svs_thumbnail.size[0])/float(lx)
 
+#extracts tiles from one slide image (and bmp label file). coordinates() and tiles() are generators of the accepted tiles, run() does what the command line does:
+#saves the tiles or their coordinates (and thumbnails) to the output directory. e.g. to get labeled tiles as arrays in memory:
+#	for x, y, label, tile in TileExtractor('234.svs', 256, 256, bmp_path = '234.svs_data/labels.bmp').tiles():
+#with handles (a HandleCache) the open slide, label image, thumbnails and label index of an earlier extraction of the same slide are reused
+class TileExtractor(object):
 
-#if there is a label file for the image create a thumbnail and find a new color for bakckground
-if args.bmp_path:
-	bmp_thumbnail = label_img.copy()
-	bmp_thumbnail.thumbnail((2000,2000))
+	def __init__(self, svs_path, tile_width, tile_height, handles = None, **options):
+		self.args = args = extraction_options(svs_path, tile_width, tile_height, **options)
+		self.starttime = time.time()
+		self.metrics = Metrics()
 
-	#find an unused color for the unlabeled tissue
-	b_color = len(bmp_thumbnail.getcolors())
+		if (args.background_threshold + args.threshold > 1.0):
+			raise TileExtractorError('there are no tiles with {0} percent background and, {1} percent tissue. please fix your thresholds'.format(args.background_threshold*100, args.threshold*100))
 
-#if there is no label image create a blank thumbnail and find color for background
-else:
-	bmp_thumbnail = Image.new('1', svs_thumbnail.size, 0)
-	b_color = 1
+		if args.shards and args.ndarray:
+			raise TileExtractorError('tiles are either packed into shards (-sh) or written into an array (-na), not both')
 
+		if args.boundary_band and not args.background_threshold:
+			raise TileExtractorError('-bb finds tiles on label or tissue boundaries, please give a background threshold with -bth')
 
+		self.overlap = args.overlap
+		self.output_dir = args.output_dir
 
-#create thumbnails
-if args.thumbnail:
-	#convert thumbnails to RGBA in order to create composites
-	svs_th = svs_thumbnail.convert("RGBA")
+		#get tile size
+		self.tile_x = args.tile_width
+		self.tile_y = args.tile_height
 
-	#create composite thumbnail
-	#this removes opacity from the white sections of the bmp file and then superimposes the labels on the .svs slide for the thumbnail
-	if args.bmp_path:
-		bmp_th = bmp_thumbnail.convert("RGBA")
-		bmp_t = list(bmp_th.getdata())
-		for i,pixel in enumerate(bmp_t):
-			a,b,c = pixel[:3]
-			if (pixel[:3] == (255,255,255)):
-				bmp_t[i] = (255,255,255,0)
-			else:
-				bmp_t[i] = ((a,b,c,120))
-		bmp_th.putdata(bmp_t)
-		#sometimes this function does not work for whatever strange reason
+		#open slide image
 		try:
-			composite_thumbnail = Image.alpha_composite(svs_th, bmp_th)
+			self.handles = handles.entry(args.svs_path, args.bmp_path) if handles else {}
+			with self.metrics.stage('open'):
+				if 'svs' not in self.handles:
+					self.handles['svs'] = openslide.OpenSlide(args.svs_path)
+			self.svs = self.handles['svs']
+			self.lx, self.ly = self.svs.dimensions
 		except Exception, e:
-			composite_thumbnail = svs_thumbnail
-
-
-
-#for more information on how this works please refer to http://scikit-image.org/docs/dev/auto_examples/segmentation/plot_label.html
-#def get_background(bmp_thumbnail):
-if ineedbackground:
-	if args.verbose:
-		sys.stdout.write('\r---        detecting image background        ---')
-		sys.stdout.flush()
-
-	for_seg = Image.new('RGB', ((svs_thumbnail.size[0]+ 15), (svs_thumbnail.size[1]+15)), (255, 255, 255)) 
-	for_seg.paste(svs_thumbnail, (5,5))
-	for_seg.save('th.jpg')
-
-	img = cv2.imread('th.jpg', 0)
-	blur = cv2.GaussianBlur(img,(25,25),0)
-	ret1, th1=cv2.threshold(blur,0,255,cv2.THRESH_OTSU)
-
-	img_GRAY = rgb2gray(invert(th1))
-	svs_arr = np.where(img_GRAY > np.mean(img_GRAY),1,0)
-	thresh = threshold_otsu(svs_arr)
-	bw = closing(svs_arr > thresh, square(3))
-	cleared = clear_border(bw)
-	label_image = label(cleared)
-	with warnings.catch_warnings():
-		warnings.simplefilter("ignore")
-		image_label_overlay = label2rgb(label_image, image=svs_arr)
-	fig, ax = plt.subplots(figsize=(10, 6))
-	ax.imshow(image_label_overlay)
-	boxes = []
-	check_area = []
-	for region in regionprops(label_image):
-		if region.area < 600:
-			#remove region from label_image
-			for coord in region.coords:
-				label_image[coord[0]][coord[1]] = 0
-
-		#if desired: for row-by-row selection get bbox of tissue areas
-		else:
+			raise TileExtractorError("Exception can not open {0} {1}. note: this may be an issue with openslide in your environment and switching to a different python environment might help".format(args.svs_path, str(e)))
+
+		#get slide resolution
+		self.mpp_x = float(self.svs.properties[openslide.PROPERTY_NAME_MPP_X])
+		self.mpp_y = float(self.svs.properties[openslide.PROPERTY_NAME_MPP_Y])
+		self.resolution = (self.mpp_x + self.mpp_y)/2
+
+		#get tile size and overlap for specifies resolution. with several resolutions tiles are selected at the first one
+		self.mpps = list(args.mpp) if isinstance(args.mpp, (list, tuple)) else [args.mpp] if args.mpp else []
+		if self.mpps:
+			mpp = self.mpps[0]
+			self.tile_x = int(self.tile_x*mpp/self.mpp_x)
+			self.tile_y = int(self.tile_y*mpp/self.mpp_y)
 			if not args.random_selection:
-				if region.area >= 600:
-					miny, minx, maxy, maxx = region.bbox
-					minx, miny, maxx, maxy = int(minx/b_ratio), int(miny/b_ratio), int(maxx/b_ratio), int(maxy/b_ratio)
-					check_area.append([(minx, maxx),(miny, maxy)])
-		
-
-	os.remove('th.jpg')
-	#end segmentation
-
-	#cover background of bmp with last number
-	for x in range(b_width):
-		for y in range(b_height):
-			if label_image[y+5][x+5] != 0 and bmp_thumbnail.getpixel((x,y)) == 0:
-				bmp_thumbnail.putpixel((x,y), b_color)
-
-
-
-
-#if thumbnail update label thumbnail to include background 
-if args.thumbnail:
-	label_thumbnail = bmp_thumbnail
-	label_thumbnail = label_thumbnail.convert('RGBA')
-
-
-
-
-if (args.verbose):
-	sys.stdout.write('\r---        beginning tile extraction         ---')
-	sys.stdout.flush()
-
-
-
-
-#get slide number for saving images
-s_path = args.svs_path.replace('/', '.').replace("\\", '.').split('.')
-slide_num = s_path[len(s_path)-2]
-
-
-
-
-#get label colors from slide and make a folder for each label color
-folder_names = []
-#make list of names of possible tile locations
-if args.bmp_path:
-	label_colors = range(1, len(label_img.getcolors()), 1)
-	for color in label_colors:
-		folder_names.append(color)
-else:
-	label_colors = ()
-
-if args.background_tiles or (args.background_threshold and not args.bmp_path) or (not args.bmp_path):
-	folder_names.append('unlabeled_tissue')
-
-#if not csv then make folders for tiles
-if args.save_tile_images:
-	for folder in folder_names:
-		newpath = newpath = os.path.join(args.output_dir, '{0}'.format(folder))
-		if not os.path.exists(newpath):
-			os.makedirs(newpath)
-
-
-#num_labels counts the number of tiles for each label color. note: the last one is unlabeled tissue
-num_labels = [0 for l in label_colors]
-if (args.background_tiles or not args.bmp_path):
-	num_labels.append(0)
-
-
-#creates array for accepted tile coordinates
-if not args.save_tile_images:
-	csv_arr = [[] for l in folder_names]
-
-
-#get thumbnail to image ratio
-s_x = float(lx)/float(svs_thumbnail.size[0])
-s_y = float(ly)/float(svs_thumbnail.size[1])
-
-
-threshold = args.threshold
-
-
-#saves tile at coordinate (x,y)
-def save_tile(x, y, label):
-	if not args.save_tile_images:
-		csv_arr[label-1].append((slide_num,(x,y),label))
-	else:
-		if not args.bmp_path:
-			label = 'unlabeled_tissue'
-
-		tile = svs.read_region( (x, y) ,0 , (tile_x, tile_y) )
+				self.overlap = args.overlap*mpp/self.resolution
+
+		#open BMP label file (the pixel data is memory-mapped, not loaded)
+		self.label_img = None
+		if args.bmp_path:
+			try:
+				with self.metrics.stage('open'):
+					if 'label_img' not in self.handles:
+						self.handles['label_img'] = PatchedPIL.LabelMap(args.bmp_path)
+				self.label_img = self.handles['label_img']
+			except Exception, e:
+				raise TileExtractorError("Exception can not open {0} {1}".format(args.bmp_path, str(e)))
+
+			#get dimensions of image
+			if (self.svs.dimensions != (self.label_img.size[0], self.label_img.size[1]) ):
+				raise TileExtractorError('Slide {0} and BMP {1} have different dimensions'.format(self.svs.dimensions, self.label_img.size))
+
+		#check if background detection is needed
+		self.ineedbackground = False
+		if (not args.bmp_path) or args.background_tiles or (args.background_threshold and not args.bmp_path):
+			self.ineedbackground = True
+
+		#find maximum tiles to check in random selection and if none is specified set to default value
+		if (args.max_tile_candidates == 0):
+			self.max_tiles = int((float(self.lx)/float(self.tile_x))*(float(self.ly)/float(self.tile_y))*10*(1+args.overlap))
+		else:
+			self.max_tiles = args.max_tile_candidates
+
+		#if row by row get the number tiles that will be checked
+		if not args.random_selection:
+			self.max_tiles = int(float(self.lx)/float(self.tile_x-self.overlap)*float(self.ly)/float(self.tile_y-self.overlap))
+
+		#check to make sure overlap is not bigger than 100 % for random selection
+		if args.random_selection and (self.overlap > 1.0):
+			raise TileExtractorError("for random selection the -o paramater should have a number between 0.0 and 1.0 indicating the maximum percent of pixel overlap between tiles")
+
+		#get slide number for saving images
+		s_path = args.svs_path.replace('/', '.').replace("\\", '.').split('.')
+		self.slide_num = s_path[len(s_path)-2]
+		if not args.save_tile_images and args.coordinate_format != 'csv' and len(self.slide_num) > COORDINATE_DTYPE['slide'].itemsize:
+			raise TileExtractorError('the slide name {0} is longer than the {1} characters of the coordinate table (-cf), please use -cf csv'.format(self.slide_num, COORDINATE_DTYPE['slide'].itemsize))
+
+		#get label colors from slide and make a folder for each label color
+		self.folder_names = []
+		#make list of names of possible tile locations
+		if args.bmp_path:
+			self.label_colors = range(1, len(self.label_img.getcolors()), 1)
+			for color in self.label_colors:
+				self.folder_names.append(color)
+		else:
+			self.label_colors = ()
+
+		if args.background_tiles or (args.background_threshold and not args.bmp_path) or (not args.bmp_path):
+			self.folder_names.append('unlabeled_tissue')
+
+		#num_labels counts the number of tiles for each label color. note: the last one is unlabeled tissue
+		self.num_labels = [0 for l in self.label_colors]
+		if (args.background_tiles or not args.bmp_path):
+			self.num_labels.append(0)
+
+		#options for reading and saving tile images with read_tile and export_tile
+		self.export_options = dict(tile_x = self.tile_x, tile_y = self.tile_y, output_dir = args.output_dir, slide_num = self.slide_num, jpeg = args.jpeg_tiles)
+		#pyramid level tiles are read from (recorded in the binary coordinate table)
+		self.level = 0
+		if self.mpps:
+			self.export_options['size'] = (args.tile_width, args.tile_height)
+			self.export_options['pyramid'] = args.pyramid_reads
+			if args.pyramid_reads:
+				self.level = pyramid_level(self.svs, self.tile_x, self.tile_y, self.export_options['size'])
+
+		#with several resolutions the (name, offset and size) level 0 region of every resolution, centred on the selected tile
+		self.scales = None
+		if len(self.mpps) > 1:
+			self.scales = []
+			for mpp in self.mpps:
+				width, height = int(args.tile_width*mpp/self.mpp_x), int(args.tile_height*mpp/self.mpp_y)
+				self.scales.append((str(mpp), self.tile_x//2 - width//2, self.tile_y//2 - height//2, width, height))
+			self.export_options['scales'] = self.scales
+
+		#with -br neighbouring tiles are collected into blocks that are read at once
+		self.blocks = None
+		if args.block_reads > 0 and not (self.mpps and args.pyramid_reads) and not self.scales:
+			self.blocks = TileBlocks(self.tile_x, self.tile_y, args.block_reads*1024*1024)
+
+		#checkpoints are only made when asked for with -ci or -re
+		self.checkpoint_interval = args.checkpoint_interval
+		if self.checkpoint_interval is None:
+			self.checkpoint_interval = CHECKPOINT_INTERVAL if args.resume else 0
+
+		#tile counter in order to cap off random tile search
+		self.tiles_found = 0
+		self.tiles_checked = 0
+		self.prepared = False
+
+		#accepted tiles as x, y, label, ... for checkpoints. step() is called every CHECKPOINT_STEP tile candidates
+		self.accepted = array.array('l')
+		self.checkpointing = False
+		self.feed_time = time.time()
+		self.feed_checked = self.feed_found = 0
+
+
+	#builds the extractor from parsed command line arguments
+	@classmethod
+	def from_args(cls, args):
+		options = dict(vars(args))
+		for name in ('svs_path', 'tile_width', 'tile_height'):
+			del options[name]
+		return cls(args.svs_path, args.tile_width, args.tile_height, **options)
+
+
+	#print variables for user debugging purposes
+	def print_settings(self):
+		args = self.args
+		print 'Slide path is', args.svs_path
+		if (args.bmp_path):
+			print 'Label image path is', args.bmp_path
+		print 'Output directory is', self.output_dir
+		print 'Image dimensions are:', self.svs.dimensions
+		if (args.bmp_path):
+			print 'Label image dimensions are: (', self.lx,',', self.ly, ')'
+		print 'The slide\'s objective power is', self.svs.properties[openslide.PROPERTY_NAME_OBJECTIVE_POWER]
+		print 'The slide\'s resolution is', self.resolution
+		print 'Tile width is:', args.tile_width, ', tile height is:', args.tile_height
+		if (args.center_pixel == 1):
+			print 'Tiles are selected by the value of their center pixel'
+		elif (args.center_pixel == 2):
+			print 'Tiles are saved if they are more than', int(args.threshold*100), 'percent labeled and if the center pixel is labeled'
+		else:
+			print 'Tiles are saved if they are more than', int(args.threshold*100), 'percent labeled'
+		#with -es (or -bb) the default maximum is only known once the eligible positions are found, random_selection prints it then
+		if (args.random_selection) and (args.eligible_sampling or args.boundary_band) and (args.max_tile_candidates == 0):
+			print 'Tiles are checked in a uniform random distribution over the eligible parts of the slide with an overlap of', int(args.overlap*100), 'percent'
+		elif (args.random_selection):
+			print 'Tiles are checked in a uniform random distribution with an overlap of', int(args.overlap*100), 'percent and a maximum of', self.max_tiles,'tiles checked' 
+		else:
+			print 'Tiles are checked row-by-row with an overlap of', int(args.overlap),'pixels, and a maximum of', self.max_tiles, 'tiles checked'
 		if (args.jpeg_tiles):
-			name = '{0}.{1}_{2}.jpeg'.format(slide_num,x,y)
-			tile = tile.convert('RGB')
-			if args.mpp:
-				tile.thumbnail((args.tile_width, args.tile_height))
-			tile.save(os.path.join(args.output_dir, '{0}'.format(label), name), 'JPEG')
+			print 'Tiles will be saved in jpeg format'
 		else:
-			name = '{0}.{1}_{2}.png'.format(slide_num,x,y)
-			if args.mpp:
-				tile.thumbnail((args.tile_width, args.tile_height))
-			tile.save(os.path.join(args.output_dir, '{0}'.format(label), name), 'PNG')
-
+			print 'Tiles will be saved in png format'
+		if (args.background_tiles):
+			print 'Tiles from unlabeled areas of tissue will also be saved'
+		else:
+			print 'Tiles from unlabeled areas of tissue will not be saved'
 		if (args.show_bmp_tiles):
-			tilebmp = label_img.crop((x,y,x+tile_x,y+tile_y))
-			name = '{0}.{1}_{2}.bmp'.format(slide_num,x,y)
-			if args.mpp:
-				tile.thumbnail((args.tile_width, args.tile_height))
-			tilebmp.save(os.path.join(args.output_dir, '{0}'.format(label), name), 'BMP')
-		
-
-
-if (args.verbose):
-	#to erase previous line
-	sys.stdout.write('\r                                                                        ')
-	sys.stdout.flush()
-	sys.stdout.write('\r')
-	sys.stdout.flush()
-
-
-
-
-
-#tile counter in order to cap off random tile search
-tiles_found = 0
-tiles_checked = 0
-
-
-
-
-#random selection
-if args.random_selection:
-	#makes a black image and fills tiles in white in order to measure tile overlap
-	tile_tracker = Image.new('1', (lx, ly), 0)
-	tile = Image.new('1', (tile_x , tile_y), 1)
-
-	#check to make sure overlap is not bigger than 100 %
-	if (overlap > 1.0):
-		print ("for random selection the -o paramater should have a number between 0.0 and 1.0 indicating the maximum percent of pixel overlap between tiles")
-		sys.exit(1)
-
-	max_overlap = overlap
-
-
-	random.seed(1)
-
-	while(tiles_checked < max_tiles):
-		tiles_checked = tiles_checked + 1
-
-		x = random.randint(0, lx-tile_x)
-		y = random.randint(0, ly-tile_y)
-
-		#if tile is checking background then tile is checked on bmp_thumbnail, otherwise the tile is checked on the label_img
-		if ineedbackground:				
-			label = tile_value(bmp_thumbnail, x, y, b_ratio, ineedbackground, args.center_pixel, tile_x, tile_y, threshold, args.background_threshold)
+			print 'Bmp tiles will also be saved in output folders'
+		if (args.thumbnail):
+			print 'Thumbnails showing tile locations will be saved in the output folder'
+		else:
+			print 'No thumbnails will be saved'
+		if (args.show_rejected_tiles):
+			print 'The locations of rejected tiles will be shown in the thumbnails'
 		else:
-			label = tile_value(label_img, x, y, b_ratio, ineedbackground, args.center_pixel, tile_x, tile_y, threshold, args.background_threshold)
-		
+			print 'The locations of rejected tiles will not be shown in the thumbnails'
 
-		#if label is colored save tile, update tile count, update the tile_tracker image, and update num_labels
-		if (label != 0 and tile_by_label_threshold_nb(tile_tracker, (x, y), tile_x, tile_y, max_overlap, 0.0) == 0):
-			tile_tracker.paste(tile, (x,y))
 
-			#if background is involved check to see if foldername should be renamed to tissue (ie. if it is an unlabeled slide it should not have a label number)
-			if args.background_tiles or (args.background_threshold and not args.bmp_path):
-				#if it is background call it unlabeled tissue
-				if (label == len(num_labels)) and args.save_tile_images:
-					foldername = 'unlabeled_tissue'
-				#otherwise call it its label number (this is necessary for csv because of csv_arr)
-				else: 
-					foldername = label
-				save_tile(x,y, foldername)
-			#if only label tiles are produced save with label number
-			else:
-				save_tile(x,y,label)
-			#update numlabels and tiles found
-			num_labels[label-1] = num_labels[label-1] + 1 
-			tiles_found = tiles_found + 1
+	#makes the slide and label thumbnails, finds the background and indexes the labels that tiles are scored against
+	def prepare(self):
+		args = self.args
 
-			#write out tiles found to stdout
+		#bmp thumbnail
+		if args.thumbnail:
 			if args.verbose:
-				prog = (tiles_checked*100)/max_tiles
-				sys.stdout.write('\r--- {0} tiles extracted. {1} percent of tiles checked ---'.format(tiles_found, prog))
+				sys.stdout.write('\r---        creating thumbnails        ---')
 				sys.stdout.flush()
 
-
-			#show tiles in the requested thumbnails
-			if args.thumbnail:
-				rec(svs_thumbnail, (x)/s_x, (y)/s_y, (x+tile_x)/s_x, (y+tile_y)/s_y, (0,0,0))
-				if args.bmp_path or args.background_threshold:
-					rec(label_thumbnail, (x)/s_x, (y)/s_y, (x+tile_x)/s_x, (y+tile_y)/s_y, (0,0,0))
-				if args.bmp_path:
-					rec(composite_thumbnail, (x)/s_x, (y)/s_y, (x+tile_x)/s_x, (y+tile_y)/s_y, (0,0,0))
-		
-		#this allows the thumbnails to show rejected tiles as well
+		#with -cd the thumbnails and the tissue segmentation are taken from earlier runs on the slide if possible, and with handles
+		#from an earlier extraction in this process (copied, as thumbnails are drawn on)
+		cached = {}
+		thumbnails_key = ('thumbnails', args.thumbnail_size, args.min_region_area)
+		if thumbnails_key in self.handles:
+			cached = dict((name, a.copy()) for name, a in self.handles[thumbnails_key].items())
+		elif args.cache_dir:
+			cache = SlideCache(args.cache_dir, args.cache_size*1024*1024)
+			cache_key = cache.key((args.svs_path, args.bmp_path), args.thumbnail_size, args.min_region_area)
+			cached = cache.load(cache_key) or {}
+		cached_names = set(cached)
+
+		#create thumbnail of slide image, record size and ratio to slide
+		if 'svs_thumbnail' in cached:
+			self.svs_thumbnail = Image.fromarray(cached['svs_thumbnail'])
 		else:
-			if args.show_rejected_tiles:
-				if args.thumbnail:
-					rec(svs_thumbnail, (x)/s_x, (y)/s_y, (x+tile_x)/s_x, (y+tile_y)/s_y, (40,180,40))
-					if args.bmp_path or args.background_threshold:
-						rec(label_thumbnail, (x)/s_x, (y)/s_y, (x+tile_x)/s_x, (y+tile_y)/s_y, (40,180,40))
-					if args.bmp_path:
-						rec(composite_thumbnail, (x)/s_x, (y)/s_y, (x+tile_x)/s_x, (y+tile_y)/s_y, (40,180,40))
-			
-
-
-
-#row-by-row selection
-else:
-	#get bbox coordinates and find all tile locations to check:
-	coords = []
-	if ineedbackground:
-		for bbox in check_area:
-			for x in range(bbox[0][0], bbox[0][1], tile_x-int(overlap)):
-				for y in range(bbox[1][0], bbox[1][1], tile_x-int(overlap)):
-					coords.append((x,y))
-	else:
-		for x in range(0, lx-tile_x, tile_x-int(overlap)):
-			for y in range(0, ly-tile_y, tile_y-int(overlap)):
-				coords.append((x,y))
-
-	for coord in coords:
-		x = coord[0]
-		y = coord[1]
-		tiles_checked = tiles_checked + 1
-
-		#if tile is checking background then tile is checked on bmp_thumbnail, otherwise the tile is checked on the label_img
-		if ineedbackground:				
-			label = tile_value(bmp_thumbnail, x,y, b_ratio, ineedbackground, args.center_pixel, tile_x, tile_y, threshold, args.background_threshold)
-		else:
-			label = tile_value(label_img, x, y, b_ratio, ineedbackground, args.center_pixel, tile_x, tile_y, threshold, args.background_threshold)
-
-
-		#if label is colored save tile and update tile count and if verbose option is on print number of tiles
-		if (label != 0):
-			#if background is involved check to see if foldername should be renamed to tissue (ie. if it is an unlabeled slide it should not have a label number)
-			if args.background_tiles or (args.background_threshold and not args.bmp_path):
-				#if it is background call it unlabeled tissue
-				if (label == len(num_labels)) and args.save_tile_images:
-					foldername = 'unlabeled_tissue'
-				#otherwise call it its label number (this is necessary for csv because of csv_arr)
-				else: 
-					foldername = label
-				save_tile(x,y, foldername)
-			#if only label tiles are produced save with label number
+			with self.metrics.stage('thumbnail'):
+				self.svs_thumbnail = self.svs.get_thumbnail((args.thumbnail_size, args.thumbnail_size))
+			cached['svs_thumbnail'] = np.asarray(self.svs_thumbnail)
+		self.b_ratio = float(self.svs_thumbnail.size[0])/float(self.lx)
+
+		#if there is a label file for the image create a thumbnail and find a new color for bakckground
+		if args.bmp_path:
+			if 'bmp_thumbnail' in cached:
+				bmp_thumbnail = Image.fromarray(cached['bmp_thumbnail'])
+				if 'palette' in cached:
+					bmp_thumbnail.putpalette(list(cached['palette']))
 			else:
-				save_tile(x,y,label)
-			#update numlabels and tiles found
-			num_labels[label-1] = num_labels[label-1] + 1 
-			tiles_found = tiles_found + 1
-
+				with self.metrics.stage('thumbnail'):
+					bmp_thumbnail = self.label_img.make_thumbnail((args.thumbnail_size, args.thumbnail_size))
+				cached['bmp_thumbnail'] = np.asarray(bmp_thumbnail)
+				#greyscale label files have no palette
+				if bmp_thumbnail.getpalette() is not None:
+					cached['palette'] = np.array(bmp_thumbnail.getpalette(), np.uint8)
 
+			#find an unused color for the unlabeled tissue
+			b_color = len(bmp_thumbnail.getcolors())
 
-			if (args.verbose):
-				prog = tiles_checked*100/max_tiles
-				sys.stdout.write('\r--- {0} tiles extracted. {1} percent of tiles checked ---'.format(tiles_found, prog))
+		#if there is no label image create a blank thumbnail and find color for background
+		else:
+			bmp_thumbnail = Image.new('L', self.svs_thumbnail.size, 0)
+			b_color = 1
+
+		#create thumbnails
+		if args.thumbnail:
+			#convert thumbnails to RGBA in order to create composites
+			svs_th = self.svs_thumbnail.convert("RGBA")
+
+			#create composite thumbnail
+			#this removes opacity from the white sections of the bmp file and then superimposes the labels on the .svs slide for the thumbnail
+			if args.bmp_path:
+				bmp_th = np.array(bmp_thumbnail.convert("RGBA"))
+				bmp_th[:,:,3] = np.where((bmp_th[:,:,:3] == 255).all(axis = 2), 0, 120)
+				bmp_th = Image.fromarray(bmp_th, 'RGBA')
+				#sometimes this function does not work for whatever strange reason
+				try:
+					self.composite_thumbnail = Image.alpha_composite(svs_th, bmp_th)
+				except Exception, e:
+					self.composite_thumbnail = self.svs_thumbnail
+
+		#find tissue in the slide thumbnail
+		self.check_area = []
+		if self.ineedbackground:
+			if args.verbose:
+				sys.stdout.write('\r---        detecting image background        ---')
 				sys.stdout.flush()
 
-			
-			# show tiles in thumbnail (this generates random colors for tiles in order to show tile overlap effectively in thumbnails)
-			a = random.randint(0, 120)
-			b = random.randint(0, 120)
-			c = random.randint(0, 120)
-
-			if args.thumbnail:
-				rec(svs_thumbnail, (x)/s_x, (y )/s_y, (x+tile_x)/s_x, (y+tile_y)/s_y, (a,b,c))
-				if args.bmp_path or args.background_threshold:
-					rec(label_thumbnail, (x)/s_x, (y )/s_y, (x+tile_x)/s_x, (y+tile_y)/s_y, (a,b,c))
-				if args.bmp_path:
-					rec(composite_thumbnail, (x)/s_x, (y )/s_y, (x+tile_x)/s_x, (y+tile_y)/s_y, (a,b,c))	
+			if 'tissue' in cached:
+				tissue, boxes = cached['tissue'], cached['boxes']
+			else:
+				with self.metrics.stage('segmentation'):
+					tissue, boxes = segment_tissue(np.asarray(self.svs_thumbnail.convert('RGB')), args.min_region_area)
+				cached['tissue'], cached['boxes'] = tissue, np.array(boxes, np.int64).reshape(-1, 4)
 
-		#allows program to show rejected tiles in thumbnail
+			#if desired: for row-by-row selection get bbox of tissue areas
+			if not args.random_selection:
+				for miny, minx, maxy, maxx in boxes:
+					minx, miny, maxx, maxy = int(minx/self.b_ratio), int(miny/self.b_ratio), int(maxx/self.b_ratio), int(maxy/self.b_ratio)
+					self.check_area.append([(minx, maxx),(miny, maxy)])
+
+			#cover background of bmp with last number
+			bmp_arr = np.array(bmp_thumbnail)
+			#the two thumbnails can differ by a pixel: tissue outside the svs thumbnail counts as background
+			h, w = min(tissue.shape[0], bmp_arr.shape[0]), min(tissue.shape[1], bmp_arr.shape[1])
+			covered = np.zeros(bmp_arr.shape, dtype = bool)
+			covered[:h, :w] = tissue[:h, :w]
+			bmp_arr[covered & (bmp_arr == 0)] = b_color
+			palette = bmp_thumbnail.getpalette()
+			bmp_thumbnail = Image.fromarray(bmp_arr)
+			if palette:
+				bmp_thumbnail.putpalette(palette)
+		self.bmp_thumbnail = bmp_thumbnail
+
+		if args.cache_dir and set(cached) != cached_names:
+			cache.save(cache_key, cached)
+		if thumbnails_key not in self.handles or set(cached) != cached_names:
+			self.handles[thumbnails_key] = dict((name, a.copy()) for name, a in cached.items())
+
+		#if thumbnail update label thumbnail to include background 
+		if args.thumbnail:
+			label_thumbnail = bmp_thumbnail
+			#without a label file the thumbnail only marks tissue (1), which is shown in white
+			if not args.bmp_path:
+				label_thumbnail = label_thumbnail.point(lambda v: 255 if v else 0)
+			self.label_thumbnail = label_thumbnail.convert('RGBA')
+
+		#index the labels that tiles are scored against once: the background-annotated thumbnail if background is needed, otherwise the full size label image
+		if (args.verbose):
+			sys.stdout.write('\r---        indexing labels         ---')
+			sys.stdout.flush()
+
+		if self.ineedbackground:
+			index_img, cell = bmp_thumbnail, 1
+			index_key = ('label_index', args.thumbnail_size, args.min_region_area)
 		else:
-			a = random.randint(190, 255)
-			b = random.randint(190, 255)
-			c = random.randint(190, 255)
-			if args.show_rejected_tiles:
-				if args.thumbnail:
-					rec(svs_thumbnail, (x)/s_x, (y )/s_y, (x+tile_x)/s_x, (y+tile_y)/s_y, (a,b,c))
-					if args.bmp_path or args.background_threshold:
-						rec(label_thumbnail, (x)/s_x, (y )/s_y, (x+tile_x)/s_x, (y+tile_y)/s_y, (a,b,c))
-					if args.bmp_path:
-						rec(composite_thumbnail, (x)/s_x, (y )/s_y, (x+tile_x)/s_x, (y+tile_y)/s_y, (a,b,c))
-			
-
-
-#save thumbnails
-if args.thumbnail:
-	svs_thumbnail.save(os.path.join(args.output_dir, slide_num + '_slide_thumbnail.png'), 'PNG')
-	if args.bmp_path:
-		composite_thumbnail.save(os.path.join(args.output_dir, slide_num + '_composite_thumbnail.png'), 'PNG')	
-	if args.bmp_path and (args.background_threshold or args.background_tiles) or not args.bmp_path:
-		label_thumbnail.save(os.path.join(args.output_dir, slide_num + '_bmp_thumbnail.png'), 'PNG')
-	
-
-
-#if csv then output csv
-if not args.save_tile_images:
-	n = 0
-	for folder in folder_names:
-		with open(os.path.join(output_dir, '{0}.csv'.format(folder)), "a+") as f:
-			writer = csv.writer(f)
-			for coordinates in csv_arr[n]:
-				writer.writerow(coordinates)
-		n = n + 1
-
-
+			index_img = self.label_img
+			if args.random_selection:
+				cell = integral_cell(self.tile_x, self.tile_y)
+			else:
+				cell = integral_cell(self.tile_x, self.tile_y, self.tile_x-int(self.overlap), self.tile_y-int(self.overlap))
+			index_key = ('label_index', cell)
+		with self.metrics.stage('label_index'):
+			if index_key not in self.handles:
+				self.handles[index_key] = LabelIntegral(index_img, cell)
+		self.label_index = self.handles[index_key]
+
+		#-bb: the boundary cells of the label index. on the thumbnail tiles of one label from 2 up pass the rules as well
+		self.boundaries = None
+		if args.boundary_band:
+			boundaries_key = ('boundaries',) + index_key
+			with self.metrics.stage('label_index'):
+				if boundaries_key not in self.handles:
+					self.handles[boundaries_key] = self.label_index.boundaries(2 if self.ineedbackground else None)
+			self.boundaries = self.handles[boundaries_key]
+
+		#get thumbnail to image ratio
+		self.s_x = float(self.lx)/float(self.svs_thumbnail.size[0])
+		self.s_y = float(self.ly)/float(self.svs_thumbnail.size[1])
+
+		#tiles are shown in the slide thumbnail, in the label thumbnail if there are labels or a background threshold and in the composite if there are labels
+		if args.thumbnail:
+			thumbnails = [self.svs_thumbnail]
+			if args.bmp_path or args.background_threshold:
+				thumbnails.append(self.label_thumbnail)
+			if args.bmp_path:
+				thumbnails.append(self.composite_thumbnail)
+			self.renderer = ThumbnailRenderer(thumbnails)
+		self.prepared = True
+
+
+	#scores a batch of tile coordinates: if tile is checking background then tiles are checked on the index of bmp_thumbnail, otherwise on the index of label_img
+	def score(self, coords):
+		args = self.args
+		return tile_values(self.label_index, coords, self.b_ratio, self.ineedbackground, args.center_pixel, self.tile_x, self.tile_y, args.threshold, args.background_threshold, self.metrics.tiles)
+
+
+	#-bb: which tiles of an (N, 2) array of tile coordinates touch a boundary cell of the label index, like score() checks them
+	def near_boundary(self, coords):
+		coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+		if self.ineedbackground:
+			b_ratio = self.b_ratio
+			return self.label_index.batch_tile_touches(self.boundaries, (coords[:, 0]*b_ratio).astype(np.int64), (coords[:, 1]*b_ratio).astype(np.int64), int(self.tile_x*b_ratio), int(self.tile_y*b_ratio))
+		return self.label_index.batch_tile_touches(self.boundaries, coords[:, 0], coords[:, 1], self.tile_x, self.tile_y)
+
+
+	#name of the folder (or csv file) a tile with this label is saved to
+	def folder_name(self, label):
+		args = self.args
+		if args.save_tile_images:
+			if not args.bmp_path:
+				return 'unlabeled_tissue'
+			#if background is involved check to see if foldername should be renamed to tissue (ie. if it is an unlabeled slide it should not have a label number)
+			if (args.background_tiles or (args.background_threshold and not args.bmp_path)) and (label == len(self.num_labels)):
+				return 'unlabeled_tissue'
+		#otherwise call it its label number (this is necessary for csv because of csv_arr)
+		return label
+
+
+	#shows a tile in the requested thumbnails (drawn in batches by the renderer)
+	def draw_tile(self, x, y, color):
+		if self.args.thumbnail:
+			s_x, s_y = self.s_x, self.s_y
+			self.renderer.add((x)/s_x, (y)/s_y, (self.tile_x+x)/s_x, (self.tile_y+y)/s_y, color)
+
+
+	#updates num_labels and tiles found for an accepted tile and writes out progress
+	def count_tile(self, x, y, label):
+		self.num_labels[label-1] = self.num_labels[label-1] + 1 
+		self.tiles_found = self.tiles_found + 1
+		self.metrics.tiles['accepted'] += 1
+		self.accepted.extend((x, y, label))
+		if self.args.verbose:
+			prog = (self.tiles_checked*100)/self.max_tiles
+			sys.stdout.write('\r--- {0} tiles extracted. {1} percent of tiles checked ---'.format(self.tiles_found, prog))
+			sys.stdout.flush()
+
+
+	#the tiles accepted so far as (x, y, label)
+	def accepted_tiles(self):
+		for i in range(0, len(self.accepted), 3):
+			yield tuple(self.accepted[i:i+3])
+
+
+	#generator of the accepted tiles as (x, y, label) in level 0 coordinates, in the order they are found.
+	#after restore() it continues after the tile candidates that were already checked
+	def coordinates(self):
+		if not self.prepared:
+			self.prepare()
+		if self.args.random_selection:
+			return self.random_selection()
+		return self.row_by_row_selection()
+
+
+	#random selection
+	def random_selection(self):
+		args = self.args
+		tile_x, tile_y = self.tile_x, self.tile_y
+
+		#-es (and -bb) draws candidates from where tiles can be accepted and blocks the positions around accepted tiles
+		sampler = self.eligible_sampler() if args.eligible_sampling or args.boundary_band else None
+		if sampler and args.verbose and args.max_tile_candidates == 0:
+			print '--- a maximum of {0} tiles are checked in the eligible parts of the slide ---'.format(self.max_tiles)
+
+		#keeps the accepted tiles in order to measure tile overlap
+		tile_tracker = TileTracker(tile_x, tile_y)
+		max_overlap = self.overlap
+		for x, y, label in self.accepted_tiles():
+			tile_tracker.add(x, y, tile_x, tile_y)
+			if sampler:
+				sampler.block(x, y)
+		if not check_tiles(self.tiles_checked, self.tiles_found, args.max_tiles_selected, self.max_tiles):
+			return
+
+		#candidates are drawn and scored in batches, then checked for overlap one by one. the candidates that were already checked
+		#are drawn again (but not scored) so the random sequence continues where it was
+		rng = random.Random(1)
+		if sampler:
+			candidates = islice(sampler.candidates(self.max_tiles, rng), self.tiles_checked, None)
+			score, batch = lambda coords: self.score_unblocked(sampler, coords), SAMPLE_BATCH
+		else:
+			candidates = islice(random_coordinates(self.lx-tile_x, self.ly-tile_y, self.max_tiles, rng), self.tiles_checked, None)
+			score, batch = self.score, SCORE_BATCH
+		for x, y, label in score_in_batches(candidates, score, batch, self.metrics):
+			self.tiles_checked = self.tiles_checked + 1
+
+			#labeled tiles are checked for overlap with the accepted tiles, those that pass update the tile_tracker
+			accepted = False
+			if (label != 0):
+				starttime = time.time()
+				accepted = tile_tracker.accepts(x, y, tile_x, tile_y, max_overlap)
+				if accepted:
+					tile_tracker.add(x, y, tile_x, tile_y)
+				else:
+					self.metrics.tiles['overlap'] += 1
+				self.metrics.add('overlap', time.time() - starttime)
+
+			#if label is colored save tile, update tile count and update num_labels
+			if accepted:
+				if sampler:
+					sampler.block(x, y)
+				self.count_tile(x, y, label)
+				#show tiles in the requested thumbnails
+				self.draw_tile(x, y, (0,0,0))
+				yield x, y, label
+
+			#this allows the thumbnails to show rejected tiles as well
+			elif args.show_rejected_tiles:
+				self.draw_tile(x, y, (40,180,40))
+
+			if self.tiles_checked % CHECKPOINT_STEP == 0:
+				self.step()
+
+			#stop at -ms tiles
+			if not check_tiles(self.tiles_checked, self.tiles_found, args.max_tiles_selected, self.max_tiles):
+				break
+
+
+	#the EligibleSampler of -es for the label index: tiles need threshold of their (index) pixels labeled, or a labeled center pixel with -cp 1,
+	#and with -bb a boundary. without -m the number of candidates is counted over the eligible positions like it is over the whole slide without -es
+	def eligible_sampler(self):
+		args = self.args
+		scale = self.b_ratio if self.ineedbackground else 1
+		total = int(self.tile_x*scale)*int(self.tile_y*scale)
+		if args.center_pixel == 1 and args.background_threshold == 0.0:
+			minimum = 1
+		else:
+			minimum = args.threshold*total
+		sampler = EligibleSampler(self.label_index, scale, self.tile_x, self.tile_y, self.lx-self.tile_x, self.ly-self.tile_y, minimum, self.overlap, self.boundaries)
+		if (args.max_tile_candidates == 0):
+			self.max_tiles = int(float(sampler.positions)/(self.tile_x*self.tile_y)*10*(1+args.overlap))
+		return sampler
+
+
+	#scores the -es candidates that are not blocked by accepted tiles, the others are rejected for overlap without being scored
+	def score_unblocked(self, sampler, coords):
+		unblocked = sampler.unblocked(coords)
+		labels = np.zeros(len(unblocked), dtype=np.int64)
+		if unblocked.any():
+			labels[unblocked] = self.score(np.asarray(coords)[unblocked])
+		self.metrics.tiles['overlap'] += int((~unblocked).sum())
+		return labels
+
+
+	#row-by-row selection
+	def row_by_row_selection(self):
+		args = self.args
+		tile_x, tile_y, overlap = self.tile_x, self.tile_y, self.overlap
+
+		#get bbox coordinates and find all tile locations to check:
+		coords = []
+		if self.ineedbackground:
+			for bbox in self.check_area:
+				for x in range(bbox[0][0], bbox[0][1], tile_x-int(overlap)):
+					for y in range(bbox[1][0], bbox[1][1], tile_x-int(overlap)):
+						coords.append((x,y))
+		else:
+			for x in range(0, self.lx-tile_x, tile_x-int(overlap)):
+				for y in range(0, self.ly-tile_y, tile_y-int(overlap)):
+					coords.append((x,y))
 
-#write information to stdout
-if args.verbose:
+		#-bb skips the tiles away from boundaries
+		if self.boundaries is not None:
+			coords = [xy for xy, near in zip(coords, self.near_boundary(coords)) if near]
 
-	if ineedbackground:
-		num_background = num_labels[len(num_labels)-1]
-		num_labels = num_labels[:(len(num_labels)-1)]
+		for x, y, label in score_in_batches(islice(coords, self.tiles_checked, None), self.score, metrics = self.metrics):
+			self.tiles_checked = self.tiles_checked + 1
 
-	sys.stdout.write("\r--- {0} total tiles found in {1} seconds ---\n".format(tiles_found, time.time() - starttime))
-	#print number of tiles per label found
-	i = 1
-	for l in num_labels:
-		print ('{0} tiles for label {1}'.format(l,i))
-		i = i+1
-	if (args.background_tiles):
-		print num_background, 'tiles for unlabeled tissue'
+			#if label is colored update tile count and if verbose option is on print number of tiles
+			if (label != 0):
+				self.count_tile(x, y, label)
+				# show tiles in thumbnail (this generates random colors for tiles in order to show tile overlap effectively in thumbnails)
+				a = random.randint(0, 120)
+				b = random.randint(0, 120)
+				c = random.randint(0, 120)
+				self.draw_tile(x, y, (a,b,c))
+				yield x, y, label
 
+			#allows program to show rejected tiles in thumbnail
+			else:
+				a = random.randint(190, 255)
+				b = random.randint(190, 255)
+				c = random.randint(190, 255)
+				if args.show_rejected_tiles:
+					self.draw_tile(x, y, (a,b,c))
+
+			if self.tiles_checked % CHECKPOINT_STEP == 0:
+				self.step()
+
+
+	#generator of the accepted tiles as (x, y, label, tile) where tile is the RGBA uint8 array of the tile image as read from the slide
+	#(shrunk to tile_width by tile_height with mpp), with several -mpp resolutions a list of the arrays of every resolution. nothing is written to disk
+	def tiles(self):
+		if not self.blocks:
+			for x, y, label in self.coordinates():
+				tiles = [np.asarray(tile) for folder, tile in self.read_tiles(x, y, label)]
+				yield x, y, label, tiles if self.scales else tiles[0]
+			return
+		#with -br the tiles of a block come when the block is complete, as views of the block
+		for block in self.tile_blocks():
+			for (x, y, label), tile in zip(block, self.read_block(block)):
+				yield x, y, label, tile
+
+
+	#generator of the accepted tiles (from coordinates()) in blocks of neighbouring tiles [(x, y, label), ...] made by self.blocks
+	def tile_blocks(self):
+		for x, y, label in self.coordinates():
+			block = self.blocks.add(x, y, label)
+			if block:
+				yield block
+		block = self.blocks.flush()
+		if block:
+			yield block
+
+
+	#the tile images of the tile at (x, y) as [(label, tile), ...], one for every resolution (see tile_maker_methods.read_tiles)
+	def read_tiles(self, x, y, label):
+		return read_tiles(self.svs, x, y, label, self.tile_x, self.tile_y, self.export_options.get('size'), self.export_options.get('pyramid', False), self.scales)
+
+
+	#the tile images of a block of tiles from self.blocks, as views of one read_region
+	def read_block(self, block):
+		with self.metrics.stage('read_region'):
+			return read_block(self.svs, block, self.tile_x, self.tile_y, self.export_options.get('size'), self.export_options.get('pyramid', False))
+
+
+	#saves one accepted tile (the tile image is read unless it is given) or its coordinates, to where the options say
+	def save(self, x, y, foldername, tile = None):
+		args = self.args
+		if not args.save_tile_images:
+			with self.metrics.stage('write'):
+				self.coordinate_writer.write(x, y, foldername)
+		elif self.export_pool:
+			self.export_pool.submit(x, y, foldername)
+		elif self.shard_writer:
+			if tile is None:
+				with self.metrics.stage('read_region'):
+					tiles = self.read_tiles(x, y, foldername)
+			else:
+				tiles = [(foldername, tile)]
+			for folder, tile in tiles:
+				if not args.ndarray:
+					with self.metrics.stage('encode'):
+						tile = encode_tile(tile, args.jpeg_tiles)
+				with self.metrics.stage('write'):
+					self.shard_writer.add(x, y, folder, tile)
+		else:
+			export_tile(self.svs, x, y, label = foldername, label_img = self.label_img if args.show_bmp_tiles else None, metrics = self.metrics, tile = tile, **self.export_options)
+
+
+	#saves a block of tiles from self.blocks, read with one read_region call (by a worker with -w)
+	def save_block(self, block):
+		if not block:
+			return
+		block = [(x, y, self.folder_name(label)) for x, y, label in block]
+		if self.export_pool:
+			self.export_pool.submit_block(block)
+			return
+		for (x, y, foldername), tile in zip(block, self.read_block(block)):
+			self.save(x, y, foldername, Image.fromarray(tile))
+
+
+	#options that have to be the same to continue from a checkpoint
+	def checkpoint_options(self):
+		options = dict(vars(self.args))
+		for name in ('output_dir', 'workers', 'block_reads', 'cache_dir', 'cache_size', 'checkpoint_interval', 'resume', 'verbose', 'metrics_report', 'metrics_feed'):
+			del options[name]
+		return options
+
+
+	#reads the checkpoint of an earlier run with the same options, None if there is none
+	def load_checkpoint(self):
+		if not os.path.exists(self.checkpoint_path):
+			return None
+		with open(self.checkpoint_path, 'rb') as f:
+			state = cPickle.load(f)
+		if state['options'] != self.checkpoint_options():
+			raise TileExtractorError('the checkpoint {0} was made with different options, run with the same options to resume'.format(self.checkpoint_path))
+		return state
+
+
+	#continues from a checkpoint: restores the counts and accepted tiles, and shows the accepted tiles in the thumbnails again
+	def restore(self, state):
+		self.tiles_checked = state['tiles_checked']
+		self.tiles_found = state['tiles_found']
+		self.num_labels = list(state['num_labels'])
+		self.accepted = state['accepted']
+		self.feed_checked, self.feed_found = self.tiles_checked, self.tiles_found
+		for x, y, label in self.accepted_tiles():
+			if self.args.random_selection:
+				self.draw_tile(x, y, (0,0,0))
+			else:
+				self.draw_tile(x, y, (random.randint(0, 120), random.randint(0, 120), random.randint(0, 120)))
+
+
+	#writes all saved tiles out and records the extraction state in the checkpoint file. the file is replaced in one rename so
+	#there is always a complete checkpoint
+	def checkpoint(self, done = False):
+		starttime = time.time()
+		if self.blocks and self.args.save_tile_images:
+			self.save_block(self.blocks.flush())
+		if self.export_pool:
+			self.export_pool.drain()
+		state = dict(options = self.checkpoint_options(), done = done, tiles_checked = self.tiles_checked, tiles_found = self.tiles_found, num_labels = self.num_labels, accepted = self.accepted,
+			coordinates = self.coordinate_writer.state() if self.coordinate_writer else None, shards = self.shard_writer.state() if self.shard_writer else None)
+		with open(self.checkpoint_path + '.tmp', 'wb') as f:
+			cPickle.dump(state, f, 2)
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(self.checkpoint_path + '.tmp', self.checkpoint_path)
+		self.checkpoint_time = time.time()
+		self.metrics.add('checkpoint', self.checkpoint_time - starttime)
+
+
+	def checkpoint_if_due(self):
+		if time.time() - self.checkpoint_time >= self.checkpoint_interval:
+			self.checkpoint()
+
+
+	#writes a line of json with the progress since the last one to stderr (the live feed of -mf)
+	def feed(self):
+		now = time.time()
+		seconds = max(now - self.feed_time, 1e-6)
+		progress = dict(slide = self.slide_num, seconds = round(now - self.starttime, 2), checked = self.tiles_checked, found = self.tiles_found,
+			checked_per_second = round((self.tiles_checked - self.feed_checked)/seconds, 1), tiles_per_second = round((self.tiles_found - self.feed_found)/seconds, 1))
+		sys.stderr.write(json.dumps(progress) + '\n')
+		sys.stderr.flush()
+		self.feed_time, self.feed_checked, self.feed_found = now, self.tiles_checked, self.tiles_found
+
+
+	#called every CHECKPOINT_STEP tile candidates: makes a checkpoint and writes the live feed when they are due
+	def step(self):
+		if self.checkpointing:
+			self.checkpoint_if_due()
+		if self.args.metrics_feed > 0 and time.time() - self.feed_time >= self.args.metrics_feed:
+			self.feed()
+
+
+	#the -mr report: the metrics of the run with the slide, the options and the tiles found per label
+	def metrics_report(self):
+		report = self.metrics.report()
+		report.update(slide = self.args.svs_path, bmp = self.args.bmp_path, options = vars(self.args), tiles_found = self.tiles_found, tiles_per_label = dict(zip(self.folder_names, self.num_labels)))
+		return report
+
+
+	#saves the accepted tiles (or their coordinates in csv files) and the requested thumbnails to the output directory
+	def run(self):
+		args = self.args
+
+		#find/make output directory
+		if not os.path.exists(self.output_dir):
+			os.makedirs(self.output_dir)
+
+		#with -re continue from the last checkpoint, if there is one
+		self.checkpoint_path = os.path.join(self.output_dir, '{0}.checkpoint'.format(self.slide_num))
+		state = None
+		if args.resume:
+			state = self.load_checkpoint()
+			if state and state['done']:
+				if args.verbose:
+					print '--- {0} was already extracted completely ---'.format(args.svs_path)
+				return
+		self.coordinate_writer = self.shard_writer = self.export_pool = None
+
+		#with shards all tiles go to the shard files of the slide, with -na to its tile array (which takes the place of the shards)
+		shard_writer = None
+		if args.save_tile_images and args.shards:
+			shard_writer = TileShardWriter(self.output_dir, self.slide_num, args.shard_size*1024*1024, state = state and state['shards'])
+		elif args.save_tile_images and args.ndarray:
+			shard_writer = TileArrayWriter(self.output_dir, self.slide_num, args.tile_width, args.tile_height, state = state and state['shards'])
+
+		#if not csv then make folders for tiles
+		elif args.save_tile_images:
+			for folder in self.folder_names:
+				for scale in self.scales or [('',)]:
+					newpath = os.path.join(self.output_dir, '{0}'.format(folder), scale[0])
+					if not os.path.exists(newpath):
+						os.makedirs(newpath)
+
+		#accepted tile coordinates are written to disk in chunks while tiles are found
+		else:
+			coordinate_writer = CoordinateWriter(self.output_dir, self.folder_names, self.slide_num, args.coordinate_format != 'table', args.coordinate_format != 'csv', self.level, state = state and state['coordinates'], scales = self.scales)
+			self.coordinate_writer = coordinate_writer
+
+		#with -w tile images are read and saved by a pool of worker processes
+		export_pool = None
+		if args.save_tile_images and args.workers > 0:
+			options = dict(self.export_options, raw = True) if args.ndarray else self.export_options
+			export_pool = TileExportPool(args.workers, args.svs_path, args.bmp_path if args.show_bmp_tiles and not shard_writer else None, options, shards = shard_writer, metrics = self.metrics)
+		self.shard_writer = shard_writer
+		self.export_pool = export_pool
+
+		if (args.verbose):
+			sys.stdout.write('---   all files opened successfully   ---')
+			sys.stdout.flush()
+
+		if not self.prepared:
+			self.prepare()
+
+		if (args.verbose):
+			#to erase previous line
+			sys.stdout.write('\r                                                                        ')
+			sys.stdout.flush()
+			sys.stdout.write('\r')
+			sys.stdout.flush()
+
+		if state:
+			self.restore(state)
+			if args.verbose:
+				print '--- resuming after {0} checked tiles, {1} tiles found ---'.format(self.tiles_checked, self.tiles_found)
 
+		#the first checkpoint records where the output files started
+		if self.checkpoint_interval > 0:
+			self.checkpoint()
+			self.checkpointing = True
 
+		#saves tile at coordinate (x,y)
+		try:
+			if self.blocks and args.save_tile_images:
+				for block in self.tile_blocks():
+					self.save_block(block)
+			else:
+				for x, y, label in self.coordinates():
+					self.save(x, y, self.folder_name(label))
+
+			#wait for the worker processes to save the remaining tiles
+			if export_pool:
+				export_pool.close()
+				self.export_pool = None
+			if self.checkpoint_interval > 0:
+				self.checkpoint(done = True)
+
+		#write out the last coordinates or shard index entries (also those found before an error)
+		finally:
+			if not args.save_tile_images:
+				with self.metrics.stage('write', 0):
+					coordinate_writer.close()
+				self.metrics.bytes_written += coordinate_writer.bytes_written
+			if shard_writer:
+				with self.metrics.stage('write', 0):
+					shard_writer.close()
+				self.metrics.bytes_written += shard_writer.bytes_written
+
+		#save thumbnails
+		if args.thumbnail:
+			with self.metrics.stage('thumbnail_output'):
+				self.renderer.flush()
+				thumbnails = [(self.svs_thumbnail, '_slide_thumbnail.png')]
+				if args.bmp_path:
+					thumbnails.append((self.composite_thumbnail, '_composite_thumbnail.png'))
+				if args.bmp_path and (args.background_threshold or args.background_tiles) or not args.bmp_path:
+					thumbnails.append((self.label_thumbnail, '_bmp_thumbnail.png'))
+				for thumbnail, name in thumbnails:
+					thumbnail.save(os.path.join(self.output_dir, self.slide_num + name), 'PNG')
+					self.metrics.bytes_written += os.path.getsize(os.path.join(self.output_dir, self.slide_num + name))
 
+		if args.metrics_report:
+			with open(os.path.join(self.output_dir, self.slide_num + '_metrics.json'), 'w') as f:
+				json.dump(self.metrics_report(), f, indent = 2, sort_keys = True)
 
+		#write information to stdout
+		if args.verbose:
+			num_labels = self.num_labels
+			if self.ineedbackground:
+				num_background = num_labels[len(num_labels)-1]
+				num_labels = num_labels[:(len(num_labels)-1)]
 
+			sys.stdout.write("\r--- {0} total tiles found in {1} seconds ---\n".format(self.tiles_found, time.time() - self.starttime))
+			#print number of tiles per label found
+			i = 1
+			for l in num_labels:
+				print ('{0} tiles for label {1}'.format(l,i))
+				i = i+1
+			if (args.background_tiles):
+				print num_background, 'tiles for unlabeled tissue'
 
- 
 
 
 
+def main(argv = None):
+	args = make_parser().parse_args(argv)
 
+	if args.verbose:
+		print "\n---    Tile Extractor. For help: python bmpTileExtractor.py -h    ---\n"
 
+	#setup errors and runs that can not go on (e.g. -re with other options than the checkpoint) end with their message
+	try:
+		extractor = TileExtractor.from_args(args)
+		if (args.verbose):
+			extractor.print_settings()
+		extractor.run()
+	except TileExtractorError, e:
+		print >> sys.stderr, e
+		sys.exit(1)
 
 
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import argparse
+import traceback
+from tileExtractor import TileExtractor, TileExtractorError
+from tile_maker_methods import HandleCache, HANDLE_CACHE
+
+
+
+
+#json strings are unicode, options and paths are used as str like on the command line
+def to_str(value):
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	if isinstance(value, list):
+		return [to_str(v) for v in value]
+	if isinstance(value, dict):
+		return dict((to_str(k), to_str(v)) for k, v in value.items())
+	return value
+
+
+
+
+#runs one extraction job: a dict with svs_path, tile_width, tile_height and any tileExtractor option by its long name
+#(e.g. {"svs_path": "234.svs", "tile_width": 256, "tile_height": 256, "bmp_path": "234.bmp", "random_selection": true}) and
+#optionally an id that is sent back. the reply has the tiles found and their coordinates, the shard or array files or the output folder
+def run_job(job, handles):
+	options = dict(job)
+	reply = {'id': options.pop('id', None), 'status': 'ok', 'error': ''}
+	starttime = time.time()
+	try:
+		extractor = TileExtractor(options.pop('svs_path'), options.pop('tile_width'), options.pop('tile_height'), handles = handles, **options)
+		extractor.run()
+		args = extractor.args
+		reply['output_dir'] = extractor.output_dir
+		reply['tiles_found'] = extractor.tiles_found
+		reply['tiles_per_label'] = dict((str(name), n) for name, n in zip(extractor.folder_names, extractor.num_labels))
+		if not args.save_tile_images:
+			reply['coordinates'] = [(x, y, extractor.folder_name(label)) for x, y, label in extractor.accepted_tiles()]
+		elif args.shards:
+			reply['shards'] = sorted(glob.glob(os.path.join(extractor.output_dir, '{0}_?????.tiles'.format(extractor.slide_num))))
+		elif args.ndarray:
+			reply['arrays'] = [os.path.join(extractor.output_dir, '{0}_{1}.npy'.format(extractor.slide_num, name)) for name in ('tiles', 'tiles_index')]
+	except TileExtractorError, e:
+		reply['status'] = 'failed'
+		reply['error'] = str(e)
+	except KeyError, e:
+		reply['status'] = 'failed'
+		reply['error'] = 'missing {0}'.format(e)
+	except Exception, e:
+		reply['status'] = 'failed'
+		reply['error'] = traceback.format_exc().strip().split('\n')[-1]
+	reply['seconds'] = time.time() - starttime
+	return reply
+
+
+
+
+#answers one line of the protocol: a job, {"command": "status"} (open slides and cache hits) or {"command": "stop"}.
+#returns the reply line and whether the daemon should stop
+def answer(line, handles):
+	try:
+		job = to_str(json.loads(line))
+	except ValueError, e:
+		return json.dumps({'status': 'failed', 'error': 'not json: {0}'.format(e)}), False
+	if not isinstance(job, dict):
+		return json.dumps({'status': 'failed', 'error': 'a job is a json object'}), False
+	command = job.get('command')
+	if command == 'stop':
+		return json.dumps({'id': job.get('id'), 'status': 'stopped'}), True
+	if command == 'status':
+		return json.dumps({'id': job.get('id'), 'status': 'ok', 'slides': len(handles.entries), 'hits': handles.hits, 'misses': handles.misses}), False
+	if command:
+		return json.dumps({'id': job.get('id'), 'status': 'failed', 'error': 'unknown command {0}'.format(command)}), False
+	#tileExtractor writes progress to stdout, which is where the replies go in stdin mode
+	stdout = sys.stdout
+	sys.stdout = sys.stderr
+	try:
+		reply = run_job(job, handles)
+	finally:
+		sys.stdout = stdout
+	return json.dumps(reply), False
+
+
+
+
+#jobs are read from stdin and replies written to stdout, one json object per line
+def serve_stdin(handles):
+	while True:
+		line = sys.stdin.readline()
+		if not line:
+			break
+		if not line.strip():
+			continue
+		reply, stop = answer(line, handles)
+		sys.stdout.write(reply + '\n')
+		sys.stdout.flush()
+		if stop:
+			break
+
+
+
+
+#jobs are read from the connections to a unix socket, one connection at a time. a connection can send any number of lines
+#and gets a reply line for each
+def serve_socket(path, handles):
+	if os.path.exists(path):
+		os.remove(path)
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(path)
+	server.listen(8)
+	stop = False
+	try:
+		while not stop:
+			connection, address = server.accept()
+			f = connection.makefile('rwb', 0)
+			try:
+				for line in iter(f.readline, ''):
+					if not line.strip():
+						continue
+					reply, stop = answer(line, handles)
+					f.write(reply + '\n')
+					if stop:
+						break
+			except socket.error, e:
+				print >> sys.stderr, 'connection closed:', e
+			finally:
+				f.close()
+				connection.close()
+	finally:
+		server.close()
+		os.remove(path)
+
+
+
+
+#sends jobs (dicts) to a daemon listening on a unix socket and yields its replies (dicts) in the same order
+def send_jobs(path, jobs):
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.connect(path)
+	f = client.makefile('rwb', 0)
+	try:
+		for job in jobs:
+			f.write(json.dumps(job) + '\n')
+			line = f.readline()
+			if not line:
+				raise IOError('the daemon closed the connection')
+			yield json.loads(line)
+	finally:
+		f.close()
+		client.close()
+
+
+
+
+def main():
+	parser = argparse.ArgumentParser( description =
+		"""
+		Keep tileExtractor.py loaded and run extraction jobs as they come in, reusing the open slides, label images, thumbnails and label indexes of recently used slides.
+		A job is a json object on one line with svs_path, tile_width, tile_height and any tileExtractor option by its long name, for example:
+		{"id": 1, "svs_path": "234.svs", "tile_width": 256, "tile_height": 256, "bmp_path": "234.bmp", "random_selection": true, "output_dir": "output/234"}
+		Jobs are read from stdin (replies to stdout) or from a unix socket with -s. {"command": "status"} and {"command": "stop"} are also understood.
+		With -c jobs read from stdin are sent to a daemon on the socket given with -s and the replies printed.
+		""")
+	parser.add_argument('-s', '--socket', default = None, help = 'path of a unix socket to listen on (or with -c to send jobs to). Without it jobs are read from stdin')
+	parser.add_argument('-hc', '--handle_cache', type = int, default = HANDLE_CACHE, help = 'number of slides kept open. Defaults to {0}'.format(HANDLE_CACHE))
+	parser.add_argument('-c', '--client', action = "store_true", help = 'send the jobs read from stdin to the daemon listening on the -s socket and print its replies')
+	args = parser.parse_args()
+
+	if args.client:
+		if not args.socket:
+			parser.error('-c needs the socket of the daemon (-s)')
+		jobs = (json.loads(line) for line in iter(sys.stdin.readline, '') if line.strip())
+		for reply in send_jobs(args.socket, jobs):
+			print json.dumps(reply)
+			sys.stdout.flush()
+		return
+
+	handles = HandleCache(args.handle_cache)
+	try:
+		if args.socket:
+			serve_socket(args.socket, handles)
+		else:
+			serve_stdin(handles)
+	finally:
+		handles.close()
+
+
+if __name__ == '__main__':
+	main()
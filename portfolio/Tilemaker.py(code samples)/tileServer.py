@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import argparse
+import threading
+import multiprocessing
+import Queue
+import urlparse
+import BaseHTTPServer
+import openslide
+from tile_maker_methods import RegionCache, REGION_CACHE, read_tile, encode_tile
+from batchTileExtractor import output_names, slides_in_directory, slides_in_manifest
+
+
+
+
+#the slides a server can serve by id: the name of their output folder in batchTileExtractor.py, which is the slide name tileExtractor.py
+#uses (e.g. 234 for input/234.svs) with a short hash of the path added for slides that share their name. a slide is opened
+#the first time a tile of it is asked for and stays open, openslide handles can be shared by threads
+class SlideLibrary(object):
+
+	def __init__(self, svs_paths):
+		self.paths = dict(zip(output_names(svs_paths), svs_paths))
+		self.slides = {}
+		self.lock = threading.Lock()
+
+
+	#the open slide of an id, KeyError if there is no such slide
+	def get(self, slide_id):
+		with self.lock:
+			if slide_id not in self.slides:
+				self.slides[slide_id] = openslide.OpenSlide(self.paths[slide_id])
+			return self.slides[slide_id]
+
+
+
+
+#an HTTPServer that answers requests with a fixed pool of threads. at most queue requests per thread wait for a thread
+class ThreadPoolHTTPServer(BaseHTTPServer.HTTPServer):
+
+	def __init__(self, address, handler, threads, queue=4):
+		BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+		self.waiting = Queue.Queue(threads*queue)
+		for i in range(threads):
+			thread = threading.Thread(target = self.serve_waiting)
+			thread.daemon = True
+			thread.start()
+
+
+	def process_request(self, request, client_address):
+		self.waiting.put((request, client_address))
+
+
+	def serve_waiting(self):
+		while True:
+			request, client_address = self.waiting.get()
+			try:
+				self.finish_request(request, client_address)
+			except Exception, e:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+
+
+
+
+#GET /tile/<slide id>?x=&y=&width=&height=[&mpp=][&pyramid=1][&format=png|jpeg|raw] serves the tile at (x, y) (level 0) the way
+#tileExtractor.py saves it: width by height pixels at the slide's own resolution or, with mpp, the region covering width by height
+#pixels at mpp resized to it (from the closest pyramid level with pyramid=1). raw is the RGBA pixels with the size in X-Tile-Width and
+#X-Tile-Height. GET /slides lists the slide ids and GET /status the cache use
+class TileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		url = urlparse.urlparse(self.path)
+		parts = [part for part in url.path.split('/') if part]
+		if parts == ['slides']:
+			self.send(200, json.dumps(sorted(self.server.library.paths)), 'application/json')
+		elif parts == ['status']:
+			cache = self.server.cache
+			self.send(200, json.dumps({'regions': len(cache.regions), 'bytes': cache.size, 'hits': cache.hits, 'misses': cache.misses}), 'application/json')
+		elif len(parts) == 2 and parts[0] == 'tile':
+			self.send_tile(parts[1], urlparse.parse_qs(url.query))
+		else:
+			self.send(404, 'not found\n')
+
+
+	def send_tile(self, slide_id, query):
+		try:
+			svs = self.server.library.get(slide_id)
+		except KeyError:
+			return self.send(404, 'no slide {0}\n'.format(slide_id))
+		except openslide.OpenSlideError, e:
+			return self.send(500, 'can not open slide {0}: {1}\n'.format(slide_id, e))
+		try:
+			x, y = int(query['x'][0]), int(query['y'][0])
+			width, height = int(query['width'][0]), int(query['height'][0])
+			mpp = float(query['mpp'][0]) if 'mpp' in query else None
+			pyramid = query.get('pyramid', ['0'])[0] == '1'
+			form = query.get('format', ['png'])[0]
+		except (KeyError, ValueError), e:
+			return self.send(400, 'x, y, width and height are needed as integers and mpp as a number\n')
+		if form not in ('png', 'jpeg', 'raw') or width <= 0 or height <= 0 or (mpp is not None and mpp <= 0):
+			return self.send(400, 'bad tile size, mpp or format\n')
+
+		#the region to read, like tileExtractor.py -mpp
+		tile_x, tile_y, size = width, height, None
+		if mpp:
+			tile_x = int(width*mpp/float(svs.properties[openslide.PROPERTY_NAME_MPP_X]))
+			tile_y = int(height*mpp/float(svs.properties[openslide.PROPERTY_NAME_MPP_Y]))
+			size = (width, height)
+		try:
+			tile = self.server.cache.get((slide_id, x, y, tile_x, tile_y, size, pyramid and bool(size)), lambda: read_tile(svs, x, y, tile_x, tile_y, size, pyramid))
+		except openslide.OpenSlideError, e:
+			return self.send(500, 'can not read the tile: {0}\n'.format(e))
+
+		if form == 'raw':
+			self.send(200, tile.tobytes(), 'application/octet-stream', {'X-Tile-Width': tile.size[0], 'X-Tile-Height': tile.size[1], 'X-Tile-Mode': tile.mode})
+		else:
+			self.send(200, encode_tile(tile, form == 'jpeg'), 'image/' + form)
+
+
+	def send(self, code, body, content_type = 'text/plain', headers = {}):
+		self.send_response(code)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', len(body))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+
+
+def main():
+	parser = argparse.ArgumentParser( description =
+		"""
+		Serve tiles of slide images over http to processes on this machine, with one cache of decoded regions shared by all of them.
+		Slides come from a directory or from a manifest with one slide path per line and are asked for by their name (234 for input/234.svs), for example:
+		python tileServer.py input/ -p 8008
+		curl 'http://localhost:8008/tile/234?x=1024&y=2048&width=256&height=256&mpp=0.5' > tile.png
+		""")
+	parser.add_argument('slides', help = 'directory of slides or manifest file')
+	parser.add_argument('-a', '--address', default = '127.0.0.1', help = 'address to listen on. Defaults to 127.0.0.1 (this machine only)')
+	parser.add_argument('-p', '--port', type = int, default = 8008, help = 'port to listen on. Defaults to 8008')
+	parser.add_argument('-th', '--threads', type = int, default = multiprocessing.cpu_count(), help = 'number of threads answering requests. Defaults to the number of cpus')
+	parser.add_argument('-cs', '--cache_size', type = int, default = REGION_CACHE/(1024*1024), help = 'maximum size in MB of the decoded regions kept in memory. Defaults to {0}'.format(REGION_CACHE/(1024*1024)))
+	parser.add_argument('-v', '--verbose', action = "store_true", help = 'log every request to stderr')
+	args = parser.parse_args()
+
+	if os.path.isdir(args.slides):
+		slides = slides_in_directory(args.slides)
+	else:
+		slides = slides_in_manifest(args.slides)
+
+	server = ThreadPoolHTTPServer((args.address, args.port), TileRequestHandler, args.threads)
+	server.library = SlideLibrary([svs_path for svs_path, bmp_path in slides])
+	server.cache = RegionCache(args.cache_size*1024*1024)
+	server.verbose = args.verbose
+	print '--- serving {0} slides on http://{1}:{2} ---'.format(len(server.library.paths), args.address, args.port)
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+
+if __name__ == '__main__':
+	main()
@@ -11,6 +11,132 @@ import time
 import argparse
 import csv
 import cv2
+import multiprocessing
+import collections
+import math
+import io
+import glob
+import hashlib
+import array
+import contextlib
+import threading
+import struct
+try:
+	import resource
+except ImportError:
+	resource = None
+import numpy as np
+from skimage.filters import threshold_otsu
+from skimage.segmentation import clear_border
+from skimage.measure import label, regionprops
+from skimage.morphology import closing, square
+from skimage.color import rgb2gray
+from skimage.util import invert
+from fractions import gcd
+from itertools import islice
+
+#default grid size (in pixels) of the summed-area table built over a full size label image
+INTEGRAL_CELL = 32
+
+#number of tile candidates scored together by score_in_batches
+SCORE_BATCH = 65536
+
+#number of EligibleSampler candidates scored together, fewer so that the tiles accepted from one batch already block candidates of the next
+SAMPLE_BATCH = 1024
+
+#number of rectangles a ThumbnailRenderer collects before drawing them
+RENDER_CHUNK = 8192
+
+#number of accepted tile coordinates a CoordinateWriter keeps before writing them to disk
+COORDINATE_CHUNK = 4096
+
+#record of the binary coordinate table: slide number, x and y (level 0), label and the pyramid level tiles are read from.
+#the slide field fits long slide names like the 36 character uuids of TCGA file names
+COORDINATE_DTYPE = np.dtype([('slide', 'S64'), ('x', '<i8'), ('y', '<i8'), ('label', '<i4'), ('level', '<i4')])
+
+#default maximum size in bytes of a tile shard file
+SHARD_SIZE = 1024*1024*1024
+
+#default maximum size in bytes of a SlideCache directory
+CACHE_SIZE = 2*1024*1024*1024
+
+#default maximum size in bytes of a block of tiles read with one read_region call by read_block
+BLOCK_SIZE = 64*1024*1024
+
+#default number of slides a HandleCache keeps open
+HANDLE_CACHE = 8
+
+#default maximum size in bytes of the decoded regions a RegionCache keeps
+REGION_CACHE = 1024*1024*1024
+
+#record of a tile shard index: where the encoded tile is in its shard, its coordinates (level 0) and its category (folder name)
+SHARD_INDEX_DTYPE = np.dtype([('offset', '<i8'), ('length', '<i8'), ('x', '<i8'), ('y', '<i8'), ('label', 'S32')])
+
+#record of a tile array index: the coordinates (level 0) and category (folder name) of the tile in the same row of the tile array
+TILE_ARRAY_INDEX_DTYPE = np.dtype([('x', '<i8'), ('y', '<i8'), ('label', 'S32')])
+
+#size in bytes of the header of a .npy file written by NpyAppender, fixed so that the rows do not move when the header is rewritten
+NPY_HEADER = 128
+
+
+
+#collects the performance metrics of an extraction: wall time and number of calls (or items) of every stage, tiles accepted and rejected
+#by reason, bytes written and peak memory. stages are timed with 'with metrics.stage(name):' or added with add. report() returns it all
+#as a dict for a json report
+class Metrics(object):
+
+	def __init__(self):
+		self.starttime = time.time()
+		self.stages = collections.OrderedDict()
+		self.tiles = collections.Counter()
+		self.bytes_written = 0
+
+
+	@contextlib.contextmanager
+	def stage(self, name, calls=1):
+		starttime = time.time()
+		try:
+			yield
+		finally:
+			self.add(name, time.time() - starttime, calls)
+
+
+	def add(self, name, seconds, calls=1):
+		if name not in self.stages:
+			self.stages[name] = [0.0, 0]
+		self.stages[name][0] += seconds
+		self.stages[name][1] += calls
+
+
+	#adds the stages and bytes written of another Metrics (e.g. of a worker process, as returned by its state())
+	def merge(self, state):
+		stages, bytes_written = state
+		for name, (seconds, calls) in stages.items():
+			self.add(name, seconds, calls)
+		self.bytes_written += bytes_written
+
+
+	def state(self):
+		return dict(self.stages), self.bytes_written
+
+
+	#peak resident memory in MB of this process and of its largest finished child process (e.g. export workers)
+	def peak_memory(self):
+		if resource is None:
+			return None, None
+		scale = 1024.0*1024.0 if sys.platform == 'darwin' else 1024.0
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/scale
+
+
+	def report(self):
+		seconds = time.time() - self.starttime
+		peak, peak_children = self.peak_memory()
+		tiles = dict(self.tiles)
+		accepted = tiles.pop('accepted', 0)
+		return {'seconds': seconds, 'stages': dict((name, {'seconds': t, 'calls': n}) for name, (t, n) in self.stages.items()),
+			'accepted_tiles': accepted, 'rejected_tiles': tiles, 'checked_tiles': accepted + sum(tiles.values()), 'bytes_written': self.bytes_written,
+			'peak_memory_mb': peak, 'peak_worker_memory_mb': peak_children}
+
 
 
 
@@ -30,9 +156,376 @@ def rec(image, x, y, x1, y1, color):
 
 
 
+
+#draws rectangles (an array of rows of x, y, x1, y1 as rec gets them after rounding, and an index into colors) on a RGB(A) image in one pass.
+#every pixel gets the color of the last rectangle that covers it, so the image is the same as after calling rec for each rectangle in
+#order, except that pixels outside the image are skipped instead of raising an IndexError
+def draw_rectangles(image, rects, colors):
+	arr = np.array(image)
+	h, w, channels = arr.shape
+	ink = np.array([tuple(color) + (255,)*(channels - len(color)) for color in colors], np.uint8)
+	x, y, x1, y1, color = [np.asarray(c, np.int64) for c in rects.T]
+	ids = np.arange(len(x))
+
+	#top and bottom rows cover x to x1-1, left and right columns cover y to y1-1, then the corner (x1, y1)
+	lx = np.maximum(x1 - x, 0)
+	ly = np.maximum(y1 - y, 0)
+	hid = np.repeat(ids, lx)
+	hoff = np.arange(len(hid)) - np.repeat(np.cumsum(lx) - lx, lx)
+	vid = np.repeat(ids, ly)
+	voff = np.arange(len(vid)) - np.repeat(np.cumsum(ly) - ly, ly)
+	px = np.concatenate((x[hid] + hoff, x[hid] + hoff, x[vid], x1[vid], x1))
+	py = np.concatenate((y[hid], y1[hid], y[vid] + voff, y[vid] + voff, y1))
+	owner = np.concatenate((hid, hid, vid, vid, ids))
+
+	inside = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+	flat = (py*w + px)[inside]
+	owner = owner[inside]
+
+	#keep the last rectangle of every pixel
+	order = np.lexsort((owner, flat))
+	flat = flat[order]
+	owner = owner[order]
+	last = np.ones(len(flat), bool)
+	last[:-1] = flat[1:] != flat[:-1]
+	arr.reshape(-1, channels)[flat[last]] = ink[color[owner[last]]]
+	image.paste(Image.fromarray(arr, image.mode))
+
+
+
+
+#collects the tile rectangles shown in thumbnails and draws them on all of the images with draw_rectangles every chunk rectangles (and
+#on flush), instead of pixel by pixel with rec. add takes the same coordinates as rec
+class ThumbnailRenderer(object):
+
+	def __init__(self, images, chunk=RENDER_CHUNK):
+		self.images = []
+		for image in images:
+			if not any(image is i for i in self.images):
+				self.images.append(image)
+		self.chunk = chunk
+		self.rects = array.array('l')
+		self.colors = []
+		self.color_ids = {}
+
+
+	def add(self, x, y, x1, y1, color):
+		if color not in self.color_ids:
+			self.color_ids[color] = len(self.colors)
+			self.colors.append(color)
+		self.rects.extend((int(x), int(y), int(x1 - 1), int(y1 - 1), self.color_ids[color]))
+		if len(self.rects) >= 5*self.chunk:
+			self.flush()
+
+
+	def flush(self):
+		if self.rects:
+			rects = np.frombuffer(self.rects, np.dtype(self.rects.typecode)).reshape(-1, 5)
+			for image in self.images:
+				draw_rectangles(image, rects, self.colors)
+		self.rects = array.array('l')
+		self.colors = []
+		self.color_ids = {}
+
+
+
+#per label summed-area table of a label image, built once per slide so that the pixel count of each label in a tile takes a few lookups instead of a crop.
+#the table is kept on a grid of cell x cell pixel blocks: tiles aligned to the grid are counted in constant time and for other tiles only the strips
+#along the edges that cover part of a cell are counted from the label pixels. cell=1 (used for thumbnails) is exact everywhere
+class LabelIntegral(object):
+
+	def __init__(self, img, cell=1):
+		if isinstance(img, PatchedPIL.LabelMap):
+			self.array = img.array
+			self.labels = int(np.flatnonzero(img.histogram())[-1]) + 1
+		else:
+			self.array = np.asarray(img, dtype=np.uint8)
+			self.labels = int(self.array.max()) + 1
+		height, width = self.array.shape
+		self.size = (width, height)
+		self.cell = cell
+		ny = -(-height // cell)
+		nx = -(-width // cell)
+		#int32 is enough unless a count can reach 2**31 pixels
+		dtype = np.int32 if width*height < 2**31 else np.int64
+		self.table = np.zeros((ny + 1, nx + 1, self.labels), dtype=dtype)
+		#counts each band of cell rows with one bincount over (cell column, label) pairs
+		cols = (np.arange(width) // cell)*self.labels
+		for j in range(ny):
+			band = self.array[j*cell:(j + 1)*cell]
+			counts = np.bincount((band + cols).ravel(), minlength=nx*self.labels)
+			self.table[j + 1, 1:] = counts.reshape(nx, self.labels)
+		np.cumsum(self.table, axis=0, out=self.table)
+		np.cumsum(self.table, axis=1, out=self.table)
+
+
+	def getpixel(self, xy):
+		return int(self.array[int(xy[1]), int(xy[0])])
+
+
+	#label counts of a rectangle of whole cells
+	def _cells(self, cl, cu, cr, cb):
+		t = self.table
+		return t[cb, cr] - t[cu, cr] - t[cb, cl] + t[cu, cl]
+
+
+	#label counts of a rectangle counted from the label pixels
+	def _pixels(self, left, upper, right, lower):
+		if left >= right or upper >= lower:
+			return 0
+		return np.bincount(self.array[upper:lower, left:right].ravel(), minlength=self.labels)
+
+
+	#number of pixels of each label inside the rectangle, ignoring the part of the rectangle outside the image
+	def counts(self, left, upper, right, lower):
+		width, height = self.size
+		left, upper = max(int(left), 0), max(int(upper), 0)
+		right, lower = min(int(right), width), min(int(lower), height)
+		if left >= right or upper >= lower:
+			return np.zeros(self.labels, dtype=np.int64)
+		c = self.cell
+		#whole cells inside the rectangle. the last row/column of cells may be cut short by the image border
+		cl, cu = -(-left // c), -(-upper // c)
+		cr = self.table.shape[1] - 1 if right == width else right // c
+		cb = self.table.shape[0] - 1 if lower == height else lower // c
+		if cl >= cr or cu >= cb:
+			return self._pixels(left, upper, right, lower).astype(np.int64)
+		x0, y0, x1, y1 = cl*c, cu*c, min(cr*c, width), min(cb*c, height)
+		counts = self._cells(cl, cu, cr, cb).astype(np.int64)
+		counts += self._pixels(left, upper, right, y0)
+		counts += self._pixels(left, y1, right, lower)
+		counts += self._pixels(left, y0, x0, y1)
+		counts += self._pixels(x1, y0, right, y1)
+		return counts
+
+
+	#same counts as crop((x, y, x+tile_x, y+tile_y)).getcolors(): pixels outside the image count as label 0
+	def tile_counts(self, x, y, tile_x, tile_y):
+		counts = self.counts(x, y, x + tile_x, y + tile_y)
+		counts[0] = tile_x*tile_y - counts[1:].sum()
+		return counts
+
+
+	#counts for arrays of rectangles as an (N, labels) array. rectangles aligned to the cell grid are looked up together,
+	#the others go through counts() one by one
+	def batch_counts(self, left, upper, right, lower):
+		width, height = self.size
+		left, right = np.clip(left, 0, width), np.clip(right, 0, width)
+		upper, lower = np.clip(upper, 0, height), np.clip(lower, 0, height)
+		c = self.cell
+		cl, cu = -(-left // c), -(-upper // c)
+		cr = np.where(right == width, self.table.shape[1] - 1, right // c)
+		cb = np.where(lower == height, self.table.shape[0] - 1, lower // c)
+		aligned = (cl < cr) & (cu < cb) & (left == cl*c) & (upper == cu*c) & (right == np.minimum(cr*c, width)) & (lower == np.minimum(cb*c, height))
+		counts = np.zeros((len(left), self.labels), dtype=np.int64)
+		counts[aligned] = self._cells(cl[aligned], cu[aligned], cr[aligned], cb[aligned])
+		for i in np.flatnonzero(~aligned):
+			counts[i] = self.counts(left[i], upper[i], right[i], lower[i])
+		return counts
+
+
+	#tile_counts for an (N, 2) array of tile coordinates
+	def batch_tile_counts(self, x, y, tile_x, tile_y):
+		counts = self.batch_counts(x, y, x + tile_x, y + tile_y)
+		counts[:, 0] = tile_x*tile_y - counts[:, 1:].sum(axis=1)
+		return counts
+
+
+	#the cells (cl, cu, cr, cb) that arrays of rectangles touch, the part outside the image left out
+	def _touched(self, left, upper, right, lower):
+		width, height = self.size
+		left, right = np.clip(left, 0, width), np.clip(right, 0, width)
+		upper, lower = np.clip(upper, 0, height), np.clip(lower, 0, height)
+		c = self.cell
+		return left // c, upper // c, np.minimum(-(-right // c), self.table.shape[1] - 1), np.minimum(-(-lower // c), self.table.shape[0] - 1)
+
+
+	#lower and upper bounds of batch_counts from the cell table alone: the counts of the cells completely inside each rectangle
+	#and of the cells it touches. the label pixels are not looked at
+	def batch_count_bounds(self, left, upper, right, lower):
+		width, height = self.size
+		left, right = np.clip(left, 0, width), np.clip(right, 0, width)
+		upper, lower = np.clip(upper, 0, height), np.clip(lower, 0, height)
+		c = self.cell
+		nx, ny = self.table.shape[1] - 1, self.table.shape[0] - 1
+		cl, cu = -(-left // c), -(-upper // c)
+		cr = np.where(right == width, nx, right // c)
+		cb = np.where(lower == height, ny, lower // c)
+		inside = (cl < cr) & (cu < cb)
+		low = np.zeros((len(left), self.labels), dtype=np.int64)
+		low[inside] = self._cells(cl[inside], cu[inside], cr[inside], cb[inside])
+		high = self._cells(*self._touched(left, upper, right, lower)).astype(np.int64)
+		high[(left >= right) | (upper >= lower)] = 0
+		return low, high
+
+
+	#batch_count_bounds for an (N, 2) array of tile coordinates, pixels outside the image count as label 0
+	def batch_tile_count_bounds(self, x, y, tile_x, tile_y):
+		low, high = self.batch_count_bounds(x, y, x + tile_x, y + tile_y)
+		low[:, 0] = tile_x*tile_y - high[:, 1:].sum(axis=1)
+		high[:, 0] = tile_x*tile_y - low[:, 1:].sum(axis=1)
+		return low, high
+
+
+	#summed-area table (like table, without the label axis) of the cells where the label changes: cells with more than one label, cells
+	#next to a cell with another label and cells on the edge of the image with a label other than 0 (the outside counts as 0). a rectangle
+	#that touches none of them has a single label. with uniform the cells of a single label >= uniform are counted as well
+	def boundaries(self, uniform=None):
+		t = self.table
+		counts = t[1:, 1:] - t[:-1, 1:] - t[1:, :-1] + t[:-1, :-1]
+		value = np.argmax(counts, axis=2)
+		value[counts.max(axis=2) < counts.sum(axis=2)] = -1
+		padded = np.pad(value, 1, 'constant')
+		boundary = (value < 0) | (value != padded[1:-1, 2:]) | (value != padded[1:-1, :-2]) | (value != padded[2:, 1:-1]) | (value != padded[:-2, 1:-1])
+		if uniform is not None:
+			boundary |= value >= uniform
+		table = np.zeros(t.shape[:2], dtype=t.dtype)
+		table[1:, 1:] = boundary
+		np.cumsum(table, axis=0, out=table)
+		np.cumsum(table, axis=1, out=table)
+		return table
+
+
+	#which tiles of arrays of tile coordinates touch a cell of a boundaries() table
+	def batch_tile_touches(self, boundaries, x, y, tile_x, tile_y):
+		cl, cu, cr, cb = self._touched(x, y, x + tile_x, y + tile_y)
+		t = boundaries
+		return t[cb, cr] - t[cu, cr] - t[cb, cl] + t[cu, cl] > 0
+
+
+
+
+#returns the cell size of the label integral for a full size label image. if all the tiles that will be checked are aligned to
+#a grid (row-by-row selection) the grid is used so that every tile is counted in constant time
+def integral_cell(tile_x, tile_y, step_x=None, step_y=None):
+	if step_x and step_y:
+		cell = gcd(gcd(int(tile_x), int(tile_y)), gcd(int(step_x), int(step_y)))
+		if cell >= INTEGRAL_CELL:
+			return cell
+	return INTEGRAL_CELL
+
+
+
+
+#label_by_threshold and label_by_threshold_on_thumbnail apply the selection rules below to an array of pixel counts indexed by label value
+def label_by_threshold(counts, total, threshold, background_threshold):
+	present = np.flatnonzero(counts)
+	passing = present[counts[present] >= threshold*total]
+	label_color = int(passing[-1]) if len(passing) else 0
+	if background_threshold > 0.0:
+		if (len(present) == 1) or (counts[present[0]] < background_threshold*total and counts[present[-1]] < background_threshold*total):
+			label_color = 0
+	return label_color
+
+
+def label_by_threshold_on_thumbnail(counts, total, threshold, background_threshold):
+	present = np.flatnonzero(counts)
+	head = present[:-1]
+	passing = head[counts[head] >= threshold*total]
+	label_color = int(passing[-1]) if len(passing) else 0
+	if label_color == 0:
+		if (counts[present[-1]] >= threshold*total):
+			label_color = int(present[-1])
+	if background_threshold > 0.0:
+		if (present[0] == 1) or (counts[present[0]] < background_threshold*total):
+			label_color = 0
+	return label_color
+
+
+
+#labels_by_threshold and labels_by_threshold_on_thumbnail are the same rules applied to every row of an (N, labels) array of counts
+def _last_true(mask):
+	return mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
+
+
+def labels_by_threshold(counts, total, threshold, background_threshold):
+	present = counts > 0
+	passing = present & (counts >= threshold*total)
+	labels = np.where(passing.any(axis=1), _last_true(passing), 0)
+	if background_threshold > 0.0:
+		rows = np.arange(len(counts))
+		first = counts[rows, np.argmax(present, axis=1)]
+		last = counts[rows, _last_true(present)]
+		labels[(present.sum(axis=1) == 1) | ((first < background_threshold*total) & (last < background_threshold*total))] = 0
+	return labels
+
+
+#labels_by_threshold from lower and upper bounds of the counts, for the tiles the bounds are enough for: a tile in which no label
+#can reach the threshold is 0 and, without background threshold, a tile in which the highest label that can reach it surely does
+#gets that label. returns the labels and which tiles were decided, the others have to be counted exactly
+def labels_by_bounds(low, high, total, threshold, background_threshold):
+	can = (high[:, 1:] > 0) & (high[:, 1:] >= threshold*total)
+	labels = np.zeros(len(low), dtype=np.int64)
+	decided = ~can.any(axis=1)
+	rows = np.flatnonzero(~decided)
+	if background_threshold == 0.0 and len(rows):
+		top = _last_true(can[rows]) + 1
+		sure = (low[rows, top] > 0) & (low[rows, top] >= threshold*total)
+		labels[rows[sure]] = top[sure]
+		decided[rows[sure]] = True
+	return labels, decided
+
+
+def labels_by_threshold_on_thumbnail(counts, total, threshold, background_threshold):
+	rows = np.arange(len(counts))
+	present = counts > 0
+	last = _last_true(present)
+	passing = present & (counts >= threshold*total)
+	head = passing.copy()
+	head[rows, last] = False
+	labels = np.where(head.any(axis=1), _last_true(head), 0)
+	labels = np.where((labels == 0) & passing[rows, last], last, labels)
+	if background_threshold > 0.0:
+		first = np.argmax(present, axis=1)
+		labels[(first == 1) | (counts[rows, first] < background_threshold*total)] = 0
+	return labels
+
+
+
+
+#finds tissue in a slide thumbnail given as an RGB array: otsu thresholding of the blurred thumbnail, then closing and connected regions.
+#returns the tissue mask of the thumbnail (regions smaller than min_region_area pixels are removed) and the (min_row, min_col, max_row, max_col)
+#bounding boxes of the tissue regions in thumbnail pixels. everything is done in memory.
+#for more information on how this works please refer to http://scikit-image.org/docs/dev/auto_examples/segmentation/plot_label.html
+def segment_tissue(thumbnail, min_region_area=600):
+	height, width = thumbnail.shape[:2]
+	#pads the thumbnail with white so that tissue on the edge of the slide is not removed by clear_border
+	img = cv2.cvtColor(np.ascontiguousarray(thumbnail, dtype=np.uint8), cv2.COLOR_RGB2GRAY)
+	img = cv2.copyMakeBorder(img, 5, 10, 5, 10, cv2.BORDER_CONSTANT, value=255)
+	blur = cv2.GaussianBlur(img,(25,25),0)
+	ret1, th1=cv2.threshold(blur,0,255,cv2.THRESH_OTSU)
+
+	img_GRAY = rgb2gray(invert(th1))
+	svs_arr = np.where(img_GRAY > np.mean(img_GRAY),1,0)
+	thresh = threshold_otsu(svs_arr)
+	bw = closing(svs_arr > thresh, square(3))
+	cleared = clear_border(bw)
+	label_image = label(cleared)
+
+	#remove regions smaller than min_region_area from label_image
+	areas = np.bincount(label_image.ravel())
+	small = areas < min_region_area
+	small[0] = False
+	label_image[small[label_image]] = 0
+
+	label_image = label_image[5:5+height, 5:5+width]
+	boxes = [region.bbox for region in regionprops(label_image)]
+	return label_image != 0, boxes
+
+
+
+
 #gets tile coordinates and returns 0 if there is no color labeled over the threshold, or the value of the label
-#this works on a full size bmp label file and has no tissue/background detection
+#this works on a full size bmp label file (or its LabelIntegral) and has no tissue/background detection
 def tile_by_label_threshold_nb(img, coordinates, tile_x, tile_y, threshold, background_threshold):	
+	if isinstance(img, LabelIntegral):
+		low, high = img.batch_tile_count_bounds(np.array([coordinates[0]]), np.array([coordinates[1]]), tile_x, tile_y)
+		labels, decided = labels_by_bounds(low, high, tile_x*tile_y, threshold, background_threshold)
+		if decided[0]:
+			return int(labels[0])
+		counts = img.tile_counts(coordinates[0], coordinates[1], tile_x, tile_y)
+		return label_by_threshold(counts, tile_x*tile_y, threshold, background_threshold)
+
 	left = coordinates[0]
 	upper = coordinates[1]
 	right = coordinates[0] + tile_x
@@ -53,7 +546,7 @@ def tile_by_label_threshold_nb(img, coordinates, tile_x, tile_y, threshold, back
 
 
 
-#similar to above but checks the thumbnail instead of the fullsize label image in order to get information about tissue location. works for background threshold but not for label/unlabeled threshold
+#similar to above but checks the thumbnail (or its LabelIntegral) instead of the fullsize label image in order to get information about tissue location. works for background threshold but not for label/unlabeled threshold
 def tile_by_threshold_on_thumbnail(img, coordinates, tile_x, tile_y, threshold, background_threshold, ratio):
 	tile_x = int(tile_x*ratio)
 	tile_y = int(tile_y*ratio)
@@ -62,6 +555,10 @@ def tile_by_threshold_on_thumbnail(img, coordinates, tile_x, tile_y, threshold,
 	right = (left+tile_x)
 	lower = (upper+tile_y)
 
+	if isinstance(img, LabelIntegral):
+		counts = img.tile_counts(left, upper, tile_x, tile_y)
+		return label_by_threshold_on_thumbnail(counts, tile_x*tile_y, threshold, background_threshold)
+
 	tile = img.crop((left, upper, right, lower))
 
 	tile_colors = tile.getcolors()
@@ -122,6 +619,257 @@ def tile_value(img, x, y, b_ratio, ineedbackground, cp, tile_x, tile_y, threshol
 
 
 
+#same as tile_value for an (N, 2) array of tile coordinates, scored in one pass over a LabelIntegral. returns an array of N labels.
+#if reasons is given (e.g. a collections.Counter) the rejected tiles are counted in it by the first rule they fail: 'threshold',
+#'background' (background threshold) or 'center_pixel'
+def tile_values(img, coords, b_ratio, ineedbackground, cp, tile_x, tile_y, threshold, background_threshold, reasons=None):
+	coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+	x = coords[:, 0]
+	y = coords[:, 1]
+	if cp in (1, 2):
+		if ineedbackground:
+			center = img.array[((y + tile_y//2)*b_ratio).astype(np.intp), ((x + tile_x//2)*b_ratio).astype(np.intp)]
+		else:
+			center = img.array[y + tile_y//2, x + tile_x//2]
+		center = center.astype(np.int64)
+	#if selection criteria is center pixel check just the center pixel
+	if (cp == 1) and (background_threshold == 0.0):
+		if reasons is not None:
+			reasons['center_pixel'] += int((center == 0).sum())
+		return center
+	if ineedbackground:
+		t_x = int(tile_x*b_ratio)
+		t_y = int(tile_y*b_ratio)
+		counts = img.batch_tile_counts((x*b_ratio).astype(np.int64), (y*b_ratio).astype(np.int64), t_x, t_y)
+		total = t_x*t_y
+		labels = labels_by_threshold_on_thumbnail(counts, total, threshold, background_threshold)
+		if reasons is not None and background_threshold > 0.0:
+			passing = labels_by_threshold_on_thumbnail(counts, total, threshold, 0.0) != 0
+	else:
+		#most tiles are decided by the cell table alone, only the others (near label borders) are counted from the label pixels
+		total = tile_x*tile_y
+		low, high = img.batch_tile_count_bounds(x, y, tile_x, tile_y)
+		labels, decided = labels_by_bounds(low, high, total, threshold, background_threshold)
+		passing = labels != 0
+		exact = np.flatnonzero(~decided)
+		if len(exact):
+			counts = img.batch_tile_counts(x[exact], y[exact], tile_x, tile_y)
+			labels[exact] = labels_by_threshold(counts, total, threshold, background_threshold)
+			if reasons is not None and background_threshold > 0.0:
+				passing[exact] = labels_by_threshold(counts, total, threshold, 0.0) != 0
+	if reasons is not None:
+		if background_threshold > 0.0:
+			reasons['threshold'] += int((~passing).sum())
+			reasons['background'] += int((passing & (labels == 0)).sum())
+		else:
+			reasons['threshold'] += int((labels == 0).sum())
+	#if it is center pixel and threshold both have to be the same label color
+	if (cp == 2):
+		if reasons is not None:
+			reasons['center_pixel'] += int(((labels != 0) & (center != labels)).sum())
+		labels = np.where(center == labels, center, 0)
+	return labels
+
+
+
+
+#scores an iterable of (x, y) coordinates batch by batch with score (e.g. a call to tile_values) and yields (x, y, label) one tile at a time.
+#with metrics the time spent making the candidates and scoring them is added to its 'candidates' and 'scoring' stages
+def score_in_batches(coords, score, batch=SCORE_BATCH, metrics=None):
+	coords = iter(coords)
+	while True:
+		starttime = time.time()
+		chunk = list(islice(coords, batch))
+		if not chunk:
+			return
+		scoretime = time.time()
+		labels = score(chunk)
+		if metrics:
+			metrics.add('candidates', scoretime - starttime, len(chunk))
+			metrics.add('scoring', time.time() - scoretime, len(chunk))
+		for (x, y), label in zip(chunk, labels):
+			yield x, y, int(label)
+
+
+
+
+#yields n uniformly distributed random tile coordinates, drawn with rng (a random.Random, the random module by default) as they are consumed
+def random_coordinates(max_x, max_y, n, rng = random):
+	for i in range(n):
+		x = rng.randint(0, max_x)
+		y = rng.randint(0, max_y)
+		yield x, y
+
+
+
+
+#draws random tile candidates (x, y) only from the positions where a tile could be accepted, instead of from the whole slide.
+#index is the LabelIntegral tiles are scored against, scale the size of an index pixel in slide pixels (b_ratio for the thumbnail index)
+#and minimum the number of labeled index pixels a tile needs. positions are grouped by the cell of the index they fall in: a cell is
+#eligible if the labeled pixels of all the cells its tiles can touch add up to minimum, which is counted from the summed-area table.
+#candidates are drawn uniformly from the slide positions of the eligible cells (one rng.random() per candidate, so they are seeded and
+#repeatable like random_coordinates). block marks where an accepted tile leaves no room for another one with less than max_overlap of
+#its pixels covered (like a poisson-disk sampler), unblocked(coords) tells which candidates are still worth scoring. with boundaries (a
+#LabelIntegral.boundaries() table of index) a cell is only eligible if its tiles can also touch a boundary cell
+class EligibleSampler(object):
+
+	def __init__(self, index, scale, tile_x, tile_y, max_x, max_y, minimum, max_overlap, boundaries=None):
+		self.tile_x = tile_x
+		self.tile_y = tile_y
+		c = index.cell
+		t_x, t_y = int(tile_x*scale), int(tile_y*scale)
+
+		#labeled pixels (any label but 0) of the cells in a summed-area table
+		labeled = index.table[:, :, 1:].sum(axis=2)
+		ny, nx = labeled.shape[0] - 1, labeled.shape[1] - 1
+
+		#for every cell of tile positions: its first slide position, its number of positions (up to last) and the last cell of the
+		#index that a tile starting in it can touch (one pixel more, for the center pixel on the thumbnail)
+		def cells(n, last, t):
+			i = np.minimum(np.arange(int(last*scale)//c + 1), n - 1)
+			start = np.minimum(np.ceil(i*c/scale).astype(np.int64), last + 1)
+			end = np.minimum(np.ceil((i + 1)*c/scale).astype(np.int64), last + 1)
+			reach = np.minimum((i*c + c - 1 + t)//c, n - 1)
+			return i, start, end - start, reach
+		ix, self.x_start, width, reach_x = cells(nx, max_x, t_x)
+		iy, self.y_start, height, reach_y = cells(ny, max_y, t_y)
+		upper = labeled[np.ix_(reach_y + 1, reach_x + 1)] - labeled[np.ix_(iy, reach_x + 1)] - labeled[np.ix_(reach_y + 1, ix)] + labeled[np.ix_(iy, ix)]
+		self.eligible = (upper >= max(minimum, 1)) & (height[:, None] > 0) & (width[None, :] > 0)
+		if boundaries is not None:
+			b = boundaries
+			self.eligible &= b[np.ix_(reach_y + 1, reach_x + 1)] - b[np.ix_(iy, reach_x + 1)] - b[np.ix_(reach_y + 1, ix)] + b[np.ix_(iy, ix)] > 0
+
+		#cells are picked in proportion to their number of positions, the position in the cell from what is left of the draw
+		self.cells = np.flatnonzero(self.eligible)
+		self.width = width
+		weights = height[self.cells//len(width)]*width[self.cells%len(width)]
+		self.cumulative = np.cumsum(weights)
+		self.positions = int(self.cumulative[-1]) if len(self.cells) else 0
+
+		#grid of slide positions (g by g pixels) that are blocked by accepted tiles: every position within reach_x, reach_y of an accepted
+		#tile has at least max_overlap of its pixels covered by it
+		self.reach_x, self.reach_y = self.block_reach(max_overlap)
+		self.grid = max(1, min(tile_x, tile_y)//4)
+		self.blocked = np.zeros((max_y//self.grid + 1, max_x//self.grid + 1), dtype=bool)
+
+
+	#offsets from an accepted tile at which a tile overlaps it by at least max_overlap of its pixels (and by at least one pixel)
+	def block_reach(self, max_overlap):
+		tile_x, tile_y = self.tile_x, self.tile_y
+		reach_x = min(int(tile_x*(1 - math.sqrt(max_overlap))), tile_x - 1)
+		reach_y = min(int(tile_y*(1 - math.sqrt(max_overlap))), tile_y - 1)
+		while (tile_x - reach_x)*(tile_y - reach_y) < max_overlap*tile_x*tile_y:
+			reach_x, reach_y = max(reach_x - 1, 0), max(reach_y - 1, 0)
+		return reach_x, reach_y
+
+
+	#yields n candidates drawn with rng (a random.Random, the random module by default), none if no position is eligible
+	def candidates(self, n, rng = random):
+		if not self.positions:
+			return
+		for i in range(n):
+			draw = int(rng.random()*self.positions)
+			k = int(np.searchsorted(self.cumulative, draw, 'right'))
+			offset = draw - (int(self.cumulative[k - 1]) if k else 0)
+			cell = self.cells[k]
+			width = int(self.width[cell%len(self.width)])
+			yield int(self.x_start[cell%len(self.width)]) + offset%width, int(self.y_start[cell//len(self.width)]) + offset//width
+
+
+	#blocks the grid cells that lie completely within reach of an accepted tile at (x, y)
+	def block(self, x, y):
+		g = self.grid
+		left, right = -(-(x - self.reach_x)//g), (x + self.reach_x + 1)//g
+		upper, lower = -(-(y - self.reach_y)//g), (y + self.reach_y + 1)//g
+		self.blocked[max(upper, 0):max(lower, 0), max(left, 0):max(right, 0)] = True
+
+
+	#boolean array of the candidates in an (N, 2) array that are not blocked
+	def unblocked(self, coords):
+		coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+		return ~self.blocked[coords[:, 1]//self.grid, coords[:, 0]//self.grid]
+
+
+
+
+#area of the union of a list of (left, upper, right, lower) rectangles, swept one strip between x edges at a time
+def union_area(rects):
+	if len(rects) == 1:
+		left, upper, right, lower = rects[0]
+		return (right - left)*(lower - upper)
+	xs = sorted(set([r[0] for r in rects] + [r[2] for r in rects]))
+	area = 0
+	for x0, x1 in zip(xs[:-1], xs[1:]):
+		spans = sorted((upper, lower) for left, upper, right, lower in rects if left <= x0 and right >= x1)
+		length = 0
+		end = None
+		for upper, lower in spans:
+			if end is None or upper > end:
+				length = length + lower - upper
+				end = lower
+			elif lower > end:
+				length = length + lower - end
+				end = lower
+		area = area + (x1 - x0)*length
+	return area
+
+
+
+
+#keeps track of accepted tiles in random selection in order to measure tile overlap. tiles are kept in a grid hash with one bucket per cell of
+#cell_x by cell_y pixels, so memory grows with the number of accepted tiles (not the size of the slide) and a new tile is only compared with its neighbours
+class TileTracker(object):
+
+	def __init__(self, cell_x, cell_y):
+		self.cell_x = int(cell_x)
+		self.cell_y = int(cell_y)
+		self.tiles = []
+		self.grid = {}
+
+
+	#keys of the grid cells the rectangle touches
+	def _cells(self, left, upper, right, lower):
+		for i in range(left//self.cell_x, (right - 1)//self.cell_x + 1):
+			for j in range(upper//self.cell_y, (lower - 1)//self.cell_y + 1):
+				yield (i, j)
+
+
+	def add(self, x, y, tile_x, tile_y):
+		n = len(self.tiles)
+		self.tiles.append((x, y, x + tile_x, y + tile_y))
+		for key in self._cells(x, y, x + tile_x, y + tile_y):
+			self.grid.setdefault(key, []).append(n)
+
+
+	#number of pixels of the tile that are already covered by accepted tiles
+	def covered(self, x, y, tile_x, tile_y):
+		right = x + tile_x
+		lower = y + tile_y
+		seen = set()
+		rects = []
+		for key in self._cells(x, y, right, lower):
+			for n in self.grid.get(key, ()):
+				if n in seen:
+					continue
+				seen.add(n)
+				l, u, r, b = self.tiles[n]
+				l, u, r, b = max(l, x), max(u, y), min(r, right), min(b, lower)
+				if l < r and u < b:
+					rects.append((l, u, r, b))
+		if not rects:
+			return 0
+		return union_area(rects)
+
+
+	#the tile can be accepted if it has no overlap or less than max_overlap of its pixels are covered by accepted tiles
+	#(the same rule as the full size tile_tracker bitmap checked with tile_by_label_threshold_nb(tile_tracker, (x, y), tile_x, tile_y, max_overlap, 0.0) == 0)
+	def accepts(self, x, y, tile_x, tile_y, max_overlap):
+		covered = self.covered(x, y, tile_x, tile_y)
+		return (covered == 0) or (covered < max_overlap*tile_x*tile_y)
+
+
+
+
 #allows you to adjust the ratio of background tiles to labeled tiles
 def can_i_save(max_background_tiles, num_labels):
 	tiles_s = 0
@@ -151,3 +899,764 @@ def check_tiles(tiles_c, tiles_f, max_tiles_selected, max_tiles):
 
 
 
+
+#returns the pyramid level to read a tile_x by tile_y (level 0 pixels) region from in order to shrink it to size: the level closest to the
+#requested downsample that still has at least size pixels. level downsamples are often slightly off (e.g. 4.0001), hence the tolerance
+def pyramid_level(svs, tile_x, tile_y, size):
+	downsample = min(float(tile_x)/size[0], float(tile_y)/size[1])
+	level = svs.get_best_level_for_downsample(downsample*1.01)
+	while level > 0:
+		level_downsample = svs.level_downsamples[level]
+		if math.ceil(tile_x/level_downsample) >= size[0] and math.ceil(tile_y/level_downsample) >= size[1]:
+			break
+		level = level - 1
+	return level
+
+
+
+
+#reads the tile_x by tile_y region at (x,y) (level 0 coordinates) from the slide. if size is given (-mpp) the tile is shrunk to fit in it.
+#with pyramid the region is read from the closest pyramid level instead of level 0, so only what is left is resized
+def read_tile(svs, x, y, tile_x, tile_y, size=None, pyramid=False):
+	if size and pyramid:
+		level = pyramid_level(svs, tile_x, tile_y, size)
+		downsample = svs.level_downsamples[level]
+		tile = svs.read_region( (x, y), level, (int(math.ceil(tile_x/downsample)), int(math.ceil(tile_y/downsample))) )
+	else:
+		tile = svs.read_region( (x, y) ,0 , (tile_x, tile_y) )
+	if size:
+		tile.thumbnail(size)
+	return tile
+
+
+
+
+#reads the tiles of several resolutions of the tile at (x, y) with one read_region call. scales are the (name, x offset, y offset, width, height)
+#level 0 regions of the resolutions, relative to (x, y), and every tile is shrunk to fit in size. the smallest region holding all of them is
+#read at level 0, or with pyramid at the pyramid level of the finest resolution, and the tiles are cut out of it
+def read_scales(svs, x, y, scales, size, pyramid=False):
+	left = x + min(ox for name, ox, oy, width, height in scales)
+	upper = y + min(oy for name, ox, oy, width, height in scales)
+	right = x + max(ox + width for name, ox, oy, width, height in scales)
+	lower = y + max(oy + height for name, ox, oy, width, height in scales)
+	level = 0
+	if pyramid:
+		level = min(pyramid_level(svs, width, height, size) for name, ox, oy, width, height in scales)
+	downsample = svs.level_downsamples[level]
+	region = svs.read_region( (left, upper), level, (int(math.ceil((right - left)/downsample)), int(math.ceil((lower - upper)/downsample))) )
+	tiles = []
+	for name, ox, oy, width, height in scales:
+		l, u = (x + ox - left)/downsample, (y + oy - upper)/downsample
+		tile = region.crop((int(l), int(u), int(math.ceil(l + width/downsample)), int(math.ceil(u + height/downsample))))
+		tile.thumbnail(size)
+		tiles.append(tile)
+	return tiles
+
+
+
+
+#the tile images of the tile at (x, y) as [(label, tile), ...]: the tile read with read_tile or, with scales, the tile of every resolution
+#read with read_scales, labeled with the folder of its resolution (<label>/<name>)
+def read_tiles(svs, x, y, label, tile_x, tile_y, size=None, pyramid=False, scales=None):
+	if not scales:
+		return [(label, read_tile(svs, x, y, tile_x, tile_y, size, pyramid))]
+	tiles = read_scales(svs, x, y, scales, size, pyramid)
+	return [(os.path.join(str(label), scale[0]), tile) for scale, tile in zip(scales, tiles)]
+
+
+
+
+#groups tiles into blocks for read_block: consecutive tiles of a row or of a column that touch or overlap (as with row-by-row selection,
+#which goes down the columns, with -o) go in one block as long as the block is at most max_size bytes (RGBA). add returns the block that
+#the new tile did not fit in, if any
+class TileBlocks(object):
+
+	def __init__(self, tile_x, tile_y, max_size=BLOCK_SIZE):
+		self.tile_x = tile_x
+		self.tile_y = tile_y
+		self.max_width = max(max_size//(tile_y*4), tile_x)
+		self.max_height = max(max_size//(tile_x*4), tile_y)
+		self.block = []
+
+
+	def add(self, x, y, label):
+		block = None
+		if self.block and not self.extends(x, y):
+			block = self.flush()
+		self.block.append((x, y, label))
+		return block
+
+
+	#whether a tile at (x, y) continues the block: it is the next tile of the row (or column) of the block and touches or overlaps its last tile
+	def extends(self, x, y):
+		first, last = self.block[0], self.block[-1]
+		row = y == first[1] and 0 < x - last[0] <= self.tile_x and x + self.tile_x - first[0] <= self.max_width
+		column = x == first[0] and 0 < y - last[1] <= self.tile_y and y + self.tile_y - first[1] <= self.max_height
+		if len(self.block) > 1:
+			row = row and last[1] == first[1]
+			column = column and last[0] == first[0]
+		return row or column
+
+
+	#the block collected so far (None if there is none), after this a new block is started
+	def flush(self):
+		block = self.block or None
+		self.block = []
+		return block
+
+
+
+
+#reads a block of tiles [(x, y, label), ...] from TileBlocks with one read_region call and returns the tiles as RGBA arrays that are
+#views of the block, the same as the tiles read one by one with read_tile. with size they are shrunk like read_tile does. with pyramid
+#(or a block of one tile) the tiles are read one by one
+def read_block(svs, tiles, tile_x, tile_y, size=None, pyramid=False):
+	if (size and pyramid) or len(tiles) == 1:
+		return [np.asarray(read_tile(svs, x, y, tile_x, tile_y, size, pyramid)) for x, y, label in tiles]
+	left, upper = tiles[0][0], tiles[0][1]
+	block = np.asarray(svs.read_region( (left, upper), 0, (tiles[-1][0] + tile_x - left, tiles[-1][1] + tile_y - upper) ))
+	images = [block[y - upper:y - upper + tile_y, x - left:x - left + tile_x] for x, y, label in tiles]
+	if size:
+		resized = []
+		for image in images:
+			image = Image.fromarray(image)
+			image.thumbnail(size)
+			resized.append(np.asarray(image))
+		images = resized
+	return images
+
+
+
+
+#reads the tile at (x,y) from the slide with read_tiles (unless the tile image is given) and saves it as png (or jpeg) to the folder of
+#its label, with scales the tile of every resolution to the folder of its resolution under the same name. if label_img is given the matching
+#tile of the label image is saved next to the (first) tile. with metrics the time spent reading, encoding and writing the tile is added to its
+#'read_region', 'encode' and 'write' stages
+def export_tile(svs, x, y, tile_x, tile_y, label, output_dir, slide_num, size=None, pyramid=False, jpeg=False, label_img=None, metrics=None, tile=None, scales=None):
+	if metrics is None:
+		metrics = Metrics()
+	if tile is None:
+		with metrics.stage('read_region'):
+			tiles = read_tiles(svs, x, y, label, tile_x, tile_y, size, pyramid, scales)
+	else:
+		tiles = [(label, tile)]
+	if (jpeg):
+		name = '{0}.{1}_{2}.jpeg'.format(slide_num,x,y)
+	else:
+		name = '{0}.{1}_{2}.png'.format(slide_num,x,y)
+	for folder, tile in tiles:
+		with metrics.stage('encode'):
+			data = encode_tile(tile, jpeg)
+		with metrics.stage('write'):
+			with open(os.path.join(output_dir, '{0}'.format(folder), name), 'wb') as f:
+				f.write(data)
+		metrics.bytes_written += len(data)
+
+	if label_img is not None:
+		tilebmp = label_img.crop((x,y,x+tile_x,y+tile_y))
+		name = '{0}.{1}_{2}.bmp'.format(slide_num,x,y)
+		tilebmp.save(os.path.join(output_dir, '{0}'.format(tiles[0][0]), name), 'BMP')
+
+
+
+
+#keeps the thumbnails and tissue segmentation of slides in a directory so that later runs on the same slide (e.g. with other tile sizes
+#or thresholds) can skip making them. an entry is a .npz file of arrays named after the identity (path, size and modification time) of
+#the slide and label files and the parameters the arrays were made with. the least recently used entries are removed when the
+#directory gets bigger than max_size bytes
+class SlideCache(object):
+
+	def __init__(self, directory, max_size=CACHE_SIZE):
+		self.directory = directory
+		self.max_size = max_size
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+
+	def key(self, paths, *params):
+		h = hashlib.sha1()
+		for path in paths:
+			if path:
+				st = os.stat(path)
+				h.update(repr((os.path.abspath(path), st.st_size, st.st_mtime)))
+		h.update(repr(params))
+		return h.hexdigest()
+
+
+	#the arrays of an entry as a dict, None if there is no (readable) entry
+	def load(self, key):
+		path = os.path.join(self.directory, key + '.npz')
+		if not os.path.exists(path):
+			return None
+		try:
+			with np.load(path) as entry:
+				arrays = dict((name, entry[name]) for name in entry.files)
+		except Exception, e:
+			return None
+		os.utime(path, None)
+		return arrays
+
+
+	#writes an entry (replacing it in one rename, so other processes never see half an entry) and removes old entries if needed
+	def save(self, key, arrays):
+		path = os.path.join(self.directory, key + '.npz')
+		tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+		with open(tmp, 'wb') as f:
+			np.savez_compressed(f, **arrays)
+		os.rename(tmp, path)
+		self.evict()
+
+
+	def evict(self):
+		entries = []
+		for name in os.listdir(self.directory):
+			if name.endswith('.npz'):
+				try:
+					st = os.stat(os.path.join(self.directory, name))
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, name))
+		total = 0
+		for mtime, size, name in sorted(entries, reverse=True):
+			total = total + size
+			if total > self.max_size:
+				try:
+					os.remove(os.path.join(self.directory, name))
+				except OSError:
+					pass
+
+
+
+
+#keeps what extractions of a slide can share open in memory between extractions in one process (the extraction daemon): an entry
+#is a dict for a slide and its label file, keyed by their identity (path, size and modification time) so that a changed file gets a
+#new entry. TileExtractor keeps the open slide ('svs') and label image ('label_img'), thumbnails and label indexes in it. the least
+#recently used entries are dropped (and their slides closed) when there are more than size of them
+class HandleCache(object):
+
+	def __init__(self, size=HANDLE_CACHE):
+		self.size = size
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+
+	def key(self, svs_path, bmp_path=None):
+		key = []
+		for path in (svs_path, bmp_path):
+			if path:
+				st = os.stat(path)
+				key.append((os.path.abspath(path), st.st_size, st.st_mtime))
+			else:
+				key.append(None)
+		return tuple(key)
+
+
+	#the entry of the slide and label file, an empty dict if they are not cached
+	def entry(self, svs_path, bmp_path=None):
+		key = self.key(svs_path, bmp_path)
+		if key in self.entries:
+			entry = self.entries.pop(key)
+			self.hits = self.hits + 1
+		else:
+			entry = {}
+			self.misses = self.misses + 1
+		self.entries[key] = entry
+		while len(self.entries) > self.size:
+			key, old = self.entries.popitem(last=False)
+			if 'svs' in old:
+				old['svs'].close()
+		return entry
+
+
+	def close(self):
+		while self.entries:
+			key, old = self.entries.popitem()
+			if 'svs' in old:
+				old['svs'].close()
+
+
+
+
+#keeps decoded tile regions (images from read_tile) in memory for all threads of a process (the tile server), the least recently used
+#are dropped when they take more than max_size bytes. a region that is being read is read only once: other threads asking for it wait
+class RegionCache(object):
+
+	def __init__(self, max_size=REGION_CACHE):
+		self.max_size = max_size
+		self.size = 0
+		self.regions = collections.OrderedDict()
+		self.reading = {}
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+
+	#the region for key, read with read() if it is not cached
+	def get(self, key, read):
+		while True:
+			with self.lock:
+				if key in self.regions:
+					region, size = self.regions.pop(key)
+					self.regions[key] = (region, size)
+					self.hits = self.hits + 1
+					return region
+				done = self.reading.get(key)
+				if done is None:
+					done = self.reading[key] = threading.Event()
+					self.misses = self.misses + 1
+					break
+			#if the region could not be read (or not cached) by the other thread it is read again here
+			done.wait()
+		try:
+			region = read()
+			size = region.size[0]*region.size[1]*len(region.getbands())
+			with self.lock:
+				if size <= self.max_size:
+					self.regions[key] = (region, size)
+					self.size = self.size + size
+					while self.size > self.max_size:
+						old, (old_region, old_size) = self.regions.popitem(last=False)
+						self.size = self.size - old_size
+		finally:
+			with self.lock:
+				del self.reading[key]
+			done.set()
+		return region
+
+
+
+
+#encodes a tile image as png (or jpeg) bytes, the same way export_tile saves it
+def encode_tile(tile, jpeg=False):
+	f = io.BytesIO()
+	if (jpeg):
+		tile.convert('RGB').save(f, 'JPEG')
+	else:
+		tile.save(f, 'PNG')
+	return f.getvalue()
+
+
+
+
+#packs encoded tiles into append-only shard files of at most shard_size bytes (<slide_num>_00000.tiles, <slide_num>_00001.tiles, ...).
+#every shard has an index file (<slide_num>_00000.index) of SHARD_INDEX_DTYPE records. tiles are only written sequentially and the
+#index is written every chunk tiles, always after the tile bytes it points to. to continue from a checkpoint pass the state() saved with it:
+#the shards started after it are removed and the last one is cut back and appended to
+class TileShardWriter(object):
+
+	def __init__(self, output_dir, slide_num, shard_size=SHARD_SIZE, chunk=COORDINATE_CHUNK, state=None):
+		self.output_dir = output_dir
+		self.slide_num = slide_num
+		self.shard_size = shard_size
+		self.chunk = chunk
+		self.shard = -1
+		self.data = None
+		self.index = None
+		self.records = []
+		self.bytes_written = 0
+		if state:
+			shard, sizes = state
+			self.remove_shards(shard)
+			truncate_files(sizes)
+			self.shard = shard - 1
+			self.open_shard('ab')
+		else:
+			#shards of an earlier run into the same folder would be read along with the new ones
+			self.remove_shards(-1)
+			self.open_shard()
+
+
+	def name(self, shard):
+		return os.path.join(self.output_dir, '{0}_{1:05d}'.format(self.slide_num, shard))
+
+
+	#removes the shard files of the slide numbered after shard
+	def remove_shards(self, shard):
+		for path in glob.glob(os.path.join(self.output_dir, '{0}_?????.tiles'.format(self.slide_num))) + glob.glob(os.path.join(self.output_dir, '{0}_?????.index'.format(self.slide_num))):
+			number = os.path.splitext(path)[0][-5:]
+			if number.isdigit() and int(number) > shard:
+				os.remove(path)
+
+
+	def open_shard(self, mode='wb'):
+		if self.data:
+			self.close()
+		self.shard = self.shard + 1
+		self.data = open(self.name(self.shard) + '.tiles', mode)
+		self.index = open(self.name(self.shard) + '.index', mode)
+		self.offset = os.fstat(self.data.fileno()).st_size
+
+
+	def add(self, x, y, label, data):
+		if self.offset and self.offset + len(data) > self.shard_size:
+			self.open_shard()
+		self.data.write(data)
+		self.records.append((self.offset, len(data), x, y, str(label)))
+		self.offset = self.offset + len(data)
+		self.bytes_written += len(data) + SHARD_INDEX_DTYPE.itemsize
+		if len(self.records) >= self.chunk:
+			self.flush()
+
+
+	def flush(self):
+		self.data.flush()
+		if self.records:
+			np.array(self.records, SHARD_INDEX_DTYPE).tofile(self.index)
+			self.index.flush()
+		self.records = []
+
+
+	#writes out the waiting index entries and returns the current shard and the sizes of its files
+	def state(self):
+		self.flush()
+		return self.shard, {self.data.name: self.offset, self.index.name: os.fstat(self.index.fileno()).st_size}
+
+
+	def close(self):
+		self.flush()
+		self.data.close()
+		self.index.close()
+
+
+
+
+#reads the tiles of all the shards of an output directory written by TileShardWriter. the indexes are loaded once into .index
+#(with the shard of every tile in .shards), after that any tile is read with one seek
+class TileShardReader(object):
+
+	def __init__(self, output_dir):
+		indexes = sorted(glob.glob(os.path.join(output_dir, '*.index')))
+		self.paths = [path[:-len('.index')] + '.tiles' for path in indexes]
+		index = [np.fromfile(path, SHARD_INDEX_DTYPE) for path in indexes]
+		self.index = np.concatenate(index) if index else np.zeros(0, SHARD_INDEX_DTYPE)
+		self.shards = np.repeat(np.arange(len(index)), [len(i) for i in index])
+		self.files = {}
+
+
+	def __len__(self):
+		return len(self.index)
+
+
+	#encoded bytes of the i-th tile
+	def read(self, i):
+		shard = self.shards[i]
+		if shard not in self.files:
+			self.files[shard] = open(self.paths[shard], 'rb')
+		f = self.files[shard]
+		f.seek(self.index['offset'][i])
+		return f.read(self.index['length'][i])
+
+
+	#the i-th tile as an image
+	def tile(self, i):
+		return Image.open(io.BytesIO(self.read(i)))
+
+
+	def close(self):
+		for f in self.files.values():
+			f.close()
+		self.files = {}
+
+
+
+
+#appends rows to a .npy file through a memory map: the file is made capacity rows bigger (doubling) whenever it is full and its header,
+#which always takes NPY_HEADER bytes, is rewritten with the number of rows when it is closed. the file can be read with
+#np.load(path, mmap_mode='r') without copying. to continue from a checkpoint pass the number of rows saved with it as rows
+class NpyAppender(object):
+
+	def __init__(self, path, dtype, shape=(), capacity=1024, rows=None):
+		self.path = path
+		self.dtype = np.dtype(dtype)
+		self.shape = tuple(shape)
+		self.row_size = self.dtype.itemsize*int(np.prod(self.shape))
+		if rows is None:
+			self.file = open(path, 'w+b')
+			self.rows = 0
+		else:
+			self.file = open(path, 'r+b')
+			self.rows = rows
+			capacity = max((os.fstat(self.file.fileno()).st_size - NPY_HEADER)//self.row_size, rows, 1)
+		self.resize(capacity)
+
+
+	def header(self, rows):
+		header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(self.dtype), (rows,) + self.shape)
+		if len(header) + 11 > NPY_HEADER:
+			raise ValueError('the .npy header of {0} does not fit in {1} bytes'.format(self.path, NPY_HEADER))
+		return '\x93NUMPY\x01\x00' + struct.pack('<H', NPY_HEADER - 10) + header.ljust(NPY_HEADER - 11) + '\n'
+
+
+	#makes the file capacity rows long (the header says so until it is closed) and maps it again
+	def resize(self, capacity):
+		self.array = None
+		self.capacity = capacity
+		self.file.seek(0)
+		self.file.write(self.header(capacity))
+		self.file.truncate(NPY_HEADER + capacity*self.row_size)
+		self.file.flush()
+		self.array = np.memmap(self.file, self.dtype, 'r+', NPY_HEADER, (capacity,) + self.shape)
+
+
+	#adds a row and returns its number, the row is written through self.array
+	def append(self):
+		if self.rows == self.capacity:
+			self.array.flush()
+			self.resize(self.capacity*2)
+		self.rows = self.rows + 1
+		return self.rows - 1
+
+
+	#writes the rows out and returns their number
+	def state(self):
+		self.array.flush()
+		return self.rows
+
+
+	#cuts the file to the rows written and gives it the right header
+	def close(self):
+		self.array.flush()
+		self.array = None
+		self.file.seek(0)
+		self.file.write(self.header(self.rows))
+		self.file.truncate(NPY_HEADER + self.rows*self.row_size)
+		self.file.close()
+
+
+
+
+#writes tile images without encoding them into a memory-mapped uint8 array <slide_num>_tiles.npy of shape (tiles, height, width, 3), with
+#the coordinates and label of every tile in the same row of <slide_num>_tiles_index.npy (TILE_ARRAY_INDEX_DTYPE records). RGBA tiles are
+#cut to RGB as they are copied in and a tile smaller than width by height (-mpp) fills the top left of its row. to continue from a
+#checkpoint pass the state() saved with it
+class TileArrayWriter(object):
+
+	def __init__(self, output_dir, slide_num, width, height, state=None):
+		self.tiles = NpyAppender(os.path.join(output_dir, '{0}_tiles.npy'.format(slide_num)), np.uint8, (height, width, 3), rows=state)
+		self.index = NpyAppender(os.path.join(output_dir, '{0}_tiles_index.npy'.format(slide_num)), TILE_ARRAY_INDEX_DTYPE, rows=state)
+		self.bytes_written = 0
+
+
+	def add(self, x, y, label, tile):
+		tile = np.asarray(tile)
+		i = self.tiles.append()
+		row = self.tiles.array[i]
+		height, width = tile.shape[:2]
+		row[:height, :width] = tile[:, :, :3]
+		if (height, width) != row.shape[:2]:
+			row[height:] = 0
+			row[:height, width:] = 0
+		i = self.index.append()
+		self.index.array[i] = (x, y, str(label))
+		self.bytes_written += self.tiles.row_size + self.index.row_size
+
+
+	#writes the rows out and returns their number
+	def state(self):
+		self.index.state()
+		return self.tiles.state()
+
+
+	def close(self):
+		self.tiles.close()
+		self.index.close()
+
+
+
+
+#slide handle, label image and export_tile options of a TileExportPool worker process, opened once per worker by _init_export_worker
+_export_worker = {}
+
+
+def _init_export_worker(svs_path, bmp_path, options):
+	_export_worker['svs'] = openslide.OpenSlide(svs_path)
+	_export_worker['label_img'] = PatchedPIL.LabelMap(bmp_path) if bmp_path else None
+	_export_worker['options'] = options
+
+
+#a job is a block of tiles [(x, y, label), ...] (see TileBlocks), read with read_block
+def _read_in_worker(job, metrics):
+	options = _export_worker['options']
+	with metrics.stage('read_region'):
+		images = read_block(_export_worker['svs'], job, options['tile_x'], options['tile_y'], options.get('size'), options.get('pyramid', False))
+	return [Image.fromarray(image) for image in images]
+
+
+#both return the metrics state of the job so that the main process can add it to its own
+def _export_in_worker(job):
+	metrics = Metrics()
+	if len(job) == 1:
+		x, y, label = job[0]
+		export_tile(_export_worker['svs'], x, y, label=label, label_img=_export_worker['label_img'], metrics=metrics, **_export_worker['options'])
+	else:
+		for (x, y, label), tile in zip(job, _read_in_worker(job, metrics)):
+			export_tile(_export_worker['svs'], x, y, label=label, label_img=_export_worker['label_img'], metrics=metrics, tile=tile, **_export_worker['options'])
+	return metrics.state()
+
+
+#with scales (jobs are single tiles then) every resolution of a tile is added to the shards with the folder of its resolution as label
+def _encode_in_worker(job):
+	options = _export_worker['options']
+	metrics = Metrics()
+	if options.get('scales'):
+		with metrics.stage('read_region'):
+			tiles = [(x, y, folder, tile) for x, y, label in job for folder, tile in read_tiles(_export_worker['svs'], x, y, label, options['tile_x'], options['tile_y'], options.get('size'), options.get('pyramid', False), options['scales'])]
+	else:
+		tiles = [(x, y, label, tile) for (x, y, label), tile in zip(job, _read_in_worker(job, metrics))]
+	#with raw (for a TileArrayWriter) the tiles are sent back as RGB arrays instead of being encoded
+	with metrics.stage('encode', len(tiles)):
+		if options.get('raw'):
+			data = [np.asarray(tile)[:, :, :3] for x, y, label, tile in tiles]
+		else:
+			data = [encode_tile(tile, options.get('jpeg', False)) for x, y, label, tile in tiles]
+	return [(x, y, label, d) for (x, y, label, tile), d in zip(tiles, data)], metrics.state()
+
+
+
+
+#saves tiles with export_tile in a pool of worker processes that each open their own OpenSlide handle (and label image if bmp_path is given).
+#at most queue tiles per worker are waiting to be saved at any time, so memory stays flat however many tiles are accepted.
+#with shards (a TileShardWriter) the workers only read and encode the tiles, which are added to the shards in order by the main process.
+#shards can also be a TileArrayWriter, with raw in options so that the tiles are not encoded.
+#with metrics the stage times of the workers (summed over all workers) are added to it. a block of tiles from TileBlocks is read with
+#one read_region call by submitting it with submit_block
+class TileExportPool(object):
+
+	def __init__(self, workers, svs_path, bmp_path, options, queue=4, shards=None, metrics=None):
+		self.pool = multiprocessing.Pool(workers, _init_export_worker, (svs_path, bmp_path, options))
+		self.pending = collections.deque()
+		self.limit = workers*queue
+		self.shards = shards
+		self.metrics = metrics
+
+
+	#queues the tile at (x, y), first waiting for the oldest queued tile if the queue is full. errors from workers are raised here
+	def submit(self, x, y, label):
+		self.submit_block([(x, y, label)])
+
+
+	def submit_block(self, tiles):
+		if len(self.pending) >= self.limit:
+			self.finish()
+		self.pending.append(self.pool.apply_async(_encode_in_worker if self.shards else _export_in_worker, (tiles,)))
+
+
+	#waits for the oldest queued tile (or block)
+	def finish(self):
+		result = self.pending.popleft().get()
+		if self.shards:
+			tiles, state = result
+			for x, y, label, data in tiles:
+				self.shards.add(x, y, label, data)
+		else:
+			state = result
+		if self.metrics:
+			self.metrics.merge(state)
+
+
+	#waits for all queued tiles to be saved
+	def drain(self):
+		while self.pending:
+			self.finish()
+
+
+	#waits for all queued tiles to be saved and stops the workers
+	def close(self):
+		self.drain()
+		self.pool.close()
+		self.pool.join()
+
+
+
+
+#cuts files back to the sizes given as {path: size}, e.g. to where they were at a checkpoint
+def truncate_files(sizes):
+	for path, size in sizes.items():
+		if os.path.exists(path):
+			with open(path, 'r+b') as f:
+				f.truncate(size)
+
+
+
+
+#writes the coordinates of accepted tiles while extraction runs, flushing them to disk every chunk tiles: one csv per label (rows of
+#slide number, (x, y), label, appended to existing files as before) and/or one binary table (coordinates.bin) of COORDINATE_DTYPE records.
+#with scales (see read_scales) every csv row also has the name and the (x, y, width, height) level 0 region of every resolution.
+#to continue from a checkpoint pass the state() saved with it, the files are cut back to it before they are appended to
+class CoordinateWriter(object):
+
+	def __init__(self, output_dir, folder_names, slide_num, csv_files=True, table=False, level=0, chunk=COORDINATE_CHUNK, state=None, scales=None):
+		if table and len(slide_num) > COORDINATE_DTYPE['slide'].itemsize:
+			raise ValueError('the slide name {0} is longer than the {1} characters of the coordinate table'.format(slide_num, COORDINATE_DTYPE['slide'].itemsize))
+		if state:
+			truncate_files(state)
+		self.slide_num = slide_num
+		self.level = level
+		self.scales = scales or ()
+		self.chunk = chunk
+		self.rows = []
+		self.files = []
+		self.writers = []
+		if csv_files:
+			for folder in folder_names:
+				self.files.append(open(os.path.join(output_dir, '{0}.csv'.format(folder)), "a+"))
+				self.writers.append(csv.writer(self.files[-1]))
+		self.table = open(os.path.join(output_dir, 'coordinates.bin'), "ab") if table else None
+		self.bytes_written = 0
+
+
+	#label n is written to the csv of the n-th folder name
+	def write(self, x, y, label):
+		self.rows.append((x, y, label))
+		if len(self.rows) >= self.chunk:
+			self.flush()
+
+
+	#total size of the files (after a flush)
+	def size(self):
+		files = self.files + ([self.table] if self.table else [])
+		return sum(os.fstat(f.fileno()).st_size for f in files)
+
+
+	def flush(self):
+		start_size = self.size()
+		if self.writers:
+			for x, y, label in self.rows:
+				row = (self.slide_num, (x, y), label)
+				for name, ox, oy, width, height in self.scales:
+					row = row + (name, (x + ox, y + oy, width, height))
+				self.writers[label-1].writerow(row)
+			for f in self.files:
+				f.flush()
+		if self.table and self.rows:
+			records = np.zeros(len(self.rows), COORDINATE_DTYPE)
+			records['slide'] = self.slide_num
+			records['x'], records['y'], records['label'] = zip(*self.rows)
+			records['level'] = self.level
+			records.tofile(self.table)
+			self.table.flush()
+		self.rows = []
+		self.bytes_written += self.size() - start_size
+
+
+	#writes out the waiting coordinates and returns the sizes of the files
+	def state(self):
+		self.flush()
+		files = self.files + ([self.table] if self.table else [])
+		return dict((f.name, os.fstat(f.fileno()).st_size) for f in files)
+
+
+	def close(self):
+		self.flush()
+		for f in self.files:
+			f.close()
+		if self.table:
+			self.table.close()
+
+
+
+
+#reads a binary coordinate table written by CoordinateWriter (or several concatenated ones) as a numpy record array
+def load_coordinates(path):
+	return np.fromfile(path, COORDINATE_DTYPE)